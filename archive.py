@@ -0,0 +1,321 @@
+import json
+import os
+import struct
+import sys
+import zlib
+from array import array
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+
+from config import ARCHIVE_DIR
+from storage import storage
+
+# On-disk layout of an hourly archive file:
+#   MAGIC | column blocks (zlib) | footer (zlib json) | footer offset/len | TRAILER
+# Every column is compressed on its own so a reader only has to seek to and
+# inflate the columns it actually needs.
+MAGIC = b'PFXCOL1\n'
+TRAILER = b'PFXC'
+TRAILER_STRUCT = struct.Struct('<QI4s')
+FILE_SUFFIX = '.pcol'
+
+TIMESTAMP_COLUMN = 'timestamp'
+ID_COLUMN = '_id'
+MISSING = 0  # dictionary slot reserved for "key not present in this document"
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _as_utc(value):
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def _to_micros(value):
+    delta = _as_utc(value) - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _from_micros(micros):
+    return _EPOCH + timedelta(microseconds=micros)
+
+
+def _hour_start(value):
+    return _as_utc(value).replace(minute=0, second=0, microsecond=0)
+
+
+def _array_bytes(values):
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _array_from_bytes(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def hour_path(hour, base_dir=None):
+    hour = _hour_start(hour)
+    return os.path.join(
+        base_dir or ARCHIVE_DIR,
+        hour.strftime('%Y'), hour.strftime('%m'), hour.strftime('%d'),
+        f"requests-{hour.strftime('%Y%m%d%H')}{FILE_SUFFIX}"
+    )
+
+
+class DictionaryColumn:
+    """Dictionary-encoded column; any JSON-serializable value is accepted."""
+
+    def __init__(self):
+        self.dictionary = [None]  # slot 0 is MISSING
+        self.lookup = {}
+        self.indices = array('I')
+
+    def _slot(self, value):
+        if isinstance(value, str):
+            lookup_key = value
+        else:
+            lookup_key = ('json', json.dumps(value, sort_keys=True, default=str))
+        slot = self.lookup.get(lookup_key)
+        if slot is None:
+            slot = len(self.dictionary)
+            self.lookup[lookup_key] = slot
+            self.dictionary.append(value)
+        return slot
+
+    def append(self, value, present=True):
+        self.indices.append(self._slot(value) if present else MISSING)
+
+    def pad(self, rows):
+        while len(self.indices) < rows:
+            self.indices.append(MISSING)
+
+    def encode(self):
+        dictionary = json.dumps(self.dictionary, default=str).encode('utf-8')
+        typecode = 'H' if len(self.dictionary) <= 0xFFFF else 'I'
+        indices = self.indices if typecode == 'I' else array('H', self.indices)
+        payload = struct.pack('<I', len(dictionary)) + dictionary + _array_bytes(indices)
+        return {'type': 'dict', 'typecode': typecode}, payload
+
+    @staticmethod
+    def decode(meta, payload):
+        (dictionary_length,) = struct.unpack_from('<I', payload)
+        dictionary = json.loads(payload[4:4 + dictionary_length].decode('utf-8'))
+        indices = _array_from_bytes(meta['typecode'], payload[4 + dictionary_length:])
+        return [(dictionary[i], i != MISSING) for i in indices]
+
+
+class HourWriter:
+    """Accumulates the documents of one hour and writes them as a single file."""
+
+    def __init__(self, hour):
+        self.hour = _hour_start(hour)
+        self.timestamps = array('q')
+        self.ids = bytearray()
+        self.columns = {}
+        self.seen_ids = set()
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def add(self, document):
+        doc_id = document.get(ID_COLUMN)
+        if not isinstance(doc_id, ObjectId):
+            doc_id = ObjectId(doc_id) if doc_id and ObjectId.is_valid(str(doc_id)) else ObjectId()
+        if doc_id.binary in self.seen_ids:
+            return
+        self.seen_ids.add(doc_id.binary)
+
+        row = len(self.timestamps)
+        self.timestamps.append(_to_micros(document[TIMESTAMP_COLUMN]))
+        self.ids += doc_id.binary
+        for key, value in document.items():
+            if key in (ID_COLUMN, TIMESTAMP_COLUMN):
+                continue
+            column = self.columns.get(key)
+            if column is None:
+                column = self.columns[key] = DictionaryColumn()
+            column.pad(row)
+            column.append(value)
+
+    def load_existing(self, path):
+        for document in read_file(path):
+            self.add(document)
+
+    def write(self, base_dir=None):
+        path = hour_path(self.hour, base_dir)
+        if os.path.exists(path):
+            self.load_existing(path)
+
+        rows = len(self.timestamps)
+        order = sorted(range(rows), key=self.timestamps.__getitem__)
+        blocks = [
+            (TIMESTAMP_COLUMN, {'type': 'ts'},
+             _array_bytes(array('q', (self.timestamps[i] for i in order)))),
+            (ID_COLUMN, {'type': 'oid'},
+             b''.join(self.ids[i * 12:(i + 1) * 12] for i in order)),
+        ]
+        for name, column in self.columns.items():
+            column.pad(rows)
+            column.indices = array('I', (column.indices[i] for i in order))
+            meta, payload = column.encode()
+            blocks.append((name, meta, payload))
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            columns = {}
+            for name, meta, payload in blocks:
+                compressed = zlib.compress(payload, 6)
+                columns[name] = {**meta, 'offset': f.tell(), 'length': len(compressed)}
+                f.write(compressed)
+            footer = zlib.compress(json.dumps({
+                'rows': rows,
+                'hour': self.hour.isoformat(),
+                'min_ts': self.timestamps[order[0]] if rows else None,
+                'max_ts': self.timestamps[order[-1]] if rows else None,
+                'columns': columns
+            }).encode('utf-8'))
+            footer_offset = f.tell()
+            f.write(footer)
+            f.write(TRAILER_STRUCT.pack(footer_offset, len(footer), TRAILER))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return path
+
+
+def read_footer(f):
+    f.seek(-TRAILER_STRUCT.size, os.SEEK_END)
+    footer_offset, footer_length, trailer = TRAILER_STRUCT.unpack(f.read(TRAILER_STRUCT.size))
+    if trailer != TRAILER:
+        raise ValueError(f"{f.name} is not a complete archive file")
+    f.seek(footer_offset)
+    return json.loads(zlib.decompress(f.read(footer_length)).decode('utf-8'))
+
+
+def _read_column(f, meta):
+    f.seek(meta['offset'])
+    payload = zlib.decompress(f.read(meta['length']))
+    if meta['type'] == 'ts':
+        return _array_from_bytes('q', payload)
+    if meta['type'] == 'oid':
+        return [ObjectId(payload[i:i + 12]) for i in range(0, len(payload), 12)]
+    return DictionaryColumn.decode(meta, payload)
+
+
+def read_file(path, columns=None, start_micros=None, end_micros=None):
+    """Yield documents from one archive file, reading only the requested columns."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an archive file")
+        footer = read_footer(f)
+        if not footer['rows']:
+            return
+        if start_micros is not None and footer['max_ts'] < start_micros:
+            return
+        if end_micros is not None and footer['min_ts'] > end_micros:
+            return
+
+        wanted = [name for name in footer['columns'] if columns is None or name in columns]
+        timestamps = _read_column(f, footer['columns'][TIMESTAMP_COLUMN])
+        data = {name: _read_column(f, footer['columns'][name])
+                for name in wanted if name != TIMESTAMP_COLUMN}
+
+    for row, micros in enumerate(timestamps):
+        if start_micros is not None and micros < start_micros:
+            continue
+        if end_micros is not None and micros > end_micros:
+            break
+        document = {}
+        for name in wanted:
+            if name == TIMESTAMP_COLUMN:
+                document[name] = _from_micros(micros)
+            elif name == ID_COLUMN:
+                document[name] = data[name][row]
+            else:
+                value, present = data[name][row]
+                if present:
+                    document[name] = value
+        yield document
+
+
+def archived_files(start_time, end_time, base_dir=None):
+    hour = _hour_start(start_time)
+    last = _hour_start(end_time)
+    while hour <= last:
+        path = hour_path(hour, base_dir)
+        if os.path.exists(path):
+            yield path
+        hour += timedelta(hours=1)
+
+
+def query(start_time, end_time, columns=None, base_dir=None):
+    """Return archived documents between start_time and end_time, newest first."""
+    if columns is not None:
+        columns = set(columns) | {TIMESTAMP_COLUMN}
+    start_micros, end_micros = _to_micros(start_time), _to_micros(end_time)
+    documents = []
+    for path in archived_files(start_time, end_time, base_dir):
+        documents.extend(read_file(path, columns, start_micros, end_micros))
+    documents.reverse()
+    return documents
+
+
+def count_by(column, start_time, end_time, base_dir=None, skip_ids=()):
+    """Count archived documents per value of a single column, leaving out skip_ids."""
+    counts = Counter()
+    for document in query(start_time, end_time, [column, ID_COLUMN], base_dir):
+        if skip_ids and str(document[ID_COLUMN]) in skip_ids:
+            continue
+        value = document.get(column)
+        counts[value if isinstance(value, (str, int, float, type(None))) else json.dumps(value)] += 1
+    return counts
+
+
+def archive_expired(cutoff, base_dir=None, batch_size=1000):
+    """Move every complete hour older than cutoff from the datastore to archive files.
+
+    Documents are streamed in timestamp order, so only one hour is held in
+    memory at a time.  Each hour's documents are deleted from the datastore
+    by _id once its file has been written and synced to disk, so requests
+    that arrive late for an hour are left for the next run.
+    """
+    hour_cutoff = _hour_start(cutoff)
+    cursor = storage.requests.older_than(hour_cutoff, batch_size)
+
+    writer = None
+    ids = []
+    archived = 0
+    for document in cursor:
+        if 'timestamp' not in document:
+            continue
+        hour = _hour_start(document['timestamp'])
+        if writer is not None and writer.hour != hour:
+            _flush(writer, ids, base_dir)
+            archived += len(ids)
+            writer, ids = None, []
+        if writer is None:
+            writer = HourWriter(hour)
+        writer.add(document)
+        ids.append(document['_id'])
+
+    if writer is not None:
+        _flush(writer, ids, base_dir)
+        archived += len(ids)
+    return archived
+
+
+def _flush(writer, ids, base_dir):
+    path = writer.write(base_dir)
+    storage.requests.delete_ids(ids)
+    print(f"Archived {len(ids)} requests to {path}")
@@ -0,0 +1,372 @@
+"""Micro-benchmarks for the policy server hot paths.
+
+Run without MongoDB, e.g.:
+
+    python benchmark.py request_record
+    python benchmark.py serialize --documents 100000
+    python benchmark.py stress --connections 64
+    python benchmark.py cold_start --rules 500 --counters 100000
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from collections import Counter
+import tracemalloc
+from datetime import datetime, timezone
+
+import bson
+from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+
+from config import JSONEncoder
+from record import parse_request
+import serialization
+from utils import determine_version, parse_data
+
+EXAMPLE_INPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example_input.raw')
+
+
+def load_example():
+    with open(EXAMPLE_INPUT) as f:
+        return f.read().strip() + '\n\n'
+
+
+def legacy_request(raw):
+    # The per-request work handle_client did before requests were parsed once:
+    # a copy of the parsed dict, and the ObjectId and timestamp converted in place
+    parsed_data = parse_data(raw)
+    instance_data = parsed_data.copy()
+    version = determine_version(instance_data)
+    instance_data['timestamp'] = datetime.now(timezone.utc)
+    instance_data['rule_results'] = []
+    instance_data['final_action'] = None
+    instance_data.pop('_id', None)
+    instance_data['_id'] = ObjectId()
+    bson.encode(instance_data)
+    instance_data['_id'] = str(instance_data['_id'])
+    instance_data['timestamp'] = instance_data['timestamp'].isoformat()
+    instance_data['final_action'] = 'DUNNO'
+    serialization.dumps({'data': instance_data, 'version': version, 'action': 'DUNNO'})
+    return instance_data
+
+
+def parsed_request(raw):
+    instance_data = parse_request(raw)
+    version = determine_version(instance_data)
+    instance_data['timestamp'] = datetime.now(timezone.utc)
+    instance_data['rule_results'] = []
+    instance_data['final_action'] = None
+    instance_data['_id'] = ObjectId()
+    bson.encode(instance_data)
+    instance_data['final_action'] = 'DUNNO'
+    serialization.dumps({'data': instance_data, 'version': version, 'action': 'DUNNO'})
+    return instance_data
+
+
+def retained_bytes(build, raw, count=10000):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    held = [build(raw) for _ in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    size = sum(stat.size_diff for stat in stats)
+    blocks = sum(stat.count_diff for stat in stats)
+    del held
+    return size / count, blocks / count
+
+
+def peak_bytes(function, raw):
+    tracemalloc.start()
+    function(raw)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def bench_request_record(args):
+    raw = load_example()
+    rows = []
+    for name, function, build in (
+        ('dict copies', legacy_request, lambda raw: parse_data(raw).copy()),
+        ('parsed once', parsed_request, parse_request),
+    ):
+        function(raw)  # warm up
+        seconds = min(timeit.repeat(lambda: function(raw), number=args.number, repeat=5)) / args.number
+        per_request, blocks = retained_bytes(build, raw)
+        rows.append((name, seconds * 1e6, per_request, blocks, peak_bytes(function, raw)))
+
+    print(f"encoder: {'orjson' if serialization.orjson is not None else 'json (orjson not installed)'}")
+    print(f"{'path':<16}{'us/request':>12}{'bytes held':>12}{'blocks held':>13}{'peak bytes':>12}")
+    for name, micros, per_request, blocks, peak in rows:
+        print(f"{name:<16}{micros:>12.1f}{per_request:>12.0f}{blocks:>13.1f}{peak:>12}")
+
+
+def stored_documents(count):
+    # BSON as the server returns it for /api/data, built from the example request
+    template = parse_data(load_example())
+    start = datetime(2026, 1, 1)
+    documents = []
+    for i in range(count):
+        document = dict(template, _id=ObjectId(), sender=f"sender{i % 5000}@example.com",
+                        timestamp=start.replace(second=i % 60, microsecond=i % 1000 * 1000),
+                        rule_results=[], final_action='DUNNO')
+        documents.append(bson.encode(document))
+    return documents
+
+
+def legacy_api_data(raw_documents):
+    # get_data before the serialization layer: decode, fix up every document, JSONEncoder
+    documents = [bson.decode(raw) for raw in raw_documents]
+    for item in documents:
+        item['timestamp'] = item['timestamp'].isoformat()
+        item['_id'] = str(item['_id'])
+    return json.dumps({'historical_data': documents}, cls=JSONEncoder).encode('utf-8')
+
+
+def json_api_data(raw_documents):
+    documents = [bson.decode(raw) for raw in raw_documents]
+    return serialization.dumps_bytes({'historical_data': documents})
+
+
+def bson_api_data(raw_documents):
+    documents = [RawBSONDocument(raw) for raw in raw_documents]
+    return serialization.bson_bytes({'historical_data': documents})
+
+
+def bench_serialize(args):
+    raw_documents = stored_documents(args.documents)
+    encoder = 'orjson' if serialization.orjson is not None else 'json (orjson not installed)'
+    print(f"{args.documents} documents, encoder: {encoder}")
+    print(f"{'path':<24}{'ms/response':>12}{'bytes':>14}")
+    for name, function in (
+        ('legacy JSONEncoder', legacy_api_data),
+        ('serialization JSON', json_api_data),
+        ('raw BSON passthrough', bson_api_data),
+    ):
+        body = function(raw_documents)
+        seconds = min(timeit.repeat(lambda: function(raw_documents), number=1, repeat=args.repeat))
+        print(f"{name:<24}{seconds * 1000:>12.1f}{len(body):>14}")
+
+
+def bench_stress(args):
+    # Policy connections run handle_client over socket pairs, so every request
+    # takes the full path (rules, spool, rate limits, recent buffer, change
+    # log) while another thread keeps replacing the rate limiter configuration
+    import policy
+    from rules import load_rules
+    from ratelimiter import rate_limiter
+    from spool import request_spool, read_segment
+
+    limit, senders = 100, 50
+    exact = {'_id': ObjectId(), 'key': 'sender', 'value': '*', 'condition': 'wildcard',
+             'limit': limit, 'duration': 60, 'customText': '', 'approximate': False}
+    rate_limiter.publish(lambda limiters: (exact,))
+    load_rules([])
+    directory = tempfile.mkdtemp(prefix='stress-spool-')
+    request_spool.directory = directory
+    request_spool.start(replay=False)
+    template = load_example().replace('sender=test@test.com', 'sender={sender}')
+    allowed = Counter()
+    allowed_lock = threading.Lock()
+    events = []  # list.append is atomic, so it can be the publish callback
+    errors = []
+    done = threading.Event()
+    start_barrier = threading.Barrier(args.connections + 1)
+
+    def connection(number):
+        seen = Counter()
+        client, server = socket.socketpair()
+        handler = threading.Thread(target=policy.handle_client, args=(server, f"stress-{number}", events.append))
+        handler.start()
+        # The socket is only closed once the file made from it is closed too
+        with client, client.makefile('r', encoding='utf-8') as responses:
+            try:
+                start_barrier.wait()
+                for i in range(args.requests):
+                    sender = f"sender{(number + i) % senders}@example.com"
+                    client.sendall(template.format(sender=sender).encode('utf-8'))
+                    response = responses.readline().strip()
+                    responses.readline()
+                    if response == 'DUNNO':
+                        seen[sender] += 1
+                    elif not response.startswith('REJECT'):
+                        raise ValueError(f"unexpected response {response!r}")
+            except Exception as e:
+                errors.append(e)
+        handler.join()
+        # Counter.update is not atomic, the merge happens once per thread
+        with allowed_lock:
+            allowed.update(seen)
+
+    def reconfigure():
+        # Copy-on-write churn: limiters that never match come and go
+        while not done.is_set():
+            extra = {'_id': ObjectId(), 'key': 'client_address', 'value': '192.0.2.1', 'condition': 'exact',
+                     'limit': 1, 'duration': 60, 'customText': '', 'approximate': False}
+            rate_limiter.publish(lambda limiters: limiters + (extra,))
+            rate_limiter.publish(lambda limiters: tuple(limiter for limiter in limiters if limiter is not extra))
+
+    # handle_client prints every connection and rejection; keep its errors only
+    output = io.StringIO()
+    threads = [threading.Thread(target=connection, args=(number,)) for number in range(args.connections)]
+    with contextlib.redirect_stdout(output):
+        for thread in threads:
+            thread.start()
+        churn = threading.Thread(target=reconfigure)
+        churn.start()
+        start_barrier.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        done.set()
+        churn.join()
+        request_spool.sync()
+    errors.extend(line for line in output.getvalue().splitlines() if line.startswith('Error processing'))
+
+    total = args.connections * args.requests
+    sent = Counter(f"sender{(number + i) % senders}@example.com"
+                   for number in range(args.connections) for i in range(args.requests))
+    counted = Counter({counter['value']: counter['count']
+                       for counter in rate_limiter.limiter_counters[exact['_id']].drain()})
+    published = {str(event['data']['_id']) for event in events}
+    versions = {event['change_version'] for event in events}
+    spooled = [str(document['_id']) for name in sorted(os.listdir(directory))
+               for document in read_segment(os.path.join(directory, name))[0]]
+    recent_ids = [key for key, _, _ in policy.data_storage.items(0, time.time())]
+    traffic_counts = {item['value']: item['count'] for item in policy.traffic_hitters.top('sender', senders)}
+    checks = [
+        ('no exceptions', not errors),
+        ('allowed == min(limit, sent) per sender', all(allowed[s] == min(limit, n) for s, n in sent.items())),
+        ('stored counters == allowed', counted == allowed),
+        ('every request published once', len(events) == len(published) == len(versions) == total),
+        ('every request spooled once', len(spooled) == total and set(spooled) == published),
+        ('recent buffer holds published requests once', len(recent_ids) == len(set(recent_ids))
+         and set(recent_ids) <= published),
+        ('traffic counts exact', traffic_counts == dict(sent)),
+    ]
+    shutil.rmtree(directory, ignore_errors=True)
+    print(f"{args.connections} connections x {args.requests} requests: "
+          f"{total / elapsed:,.0f} requests/s")
+    for name, passed in checks:
+        print(f"{'PASS' if passed else 'FAIL'}  {name}")
+    for e in errors[:5]:
+        print(f"  {type(e).__name__}: {e}")
+    if not all(passed for _, passed in checks):
+        sys.exit(1)
+
+
+def seed_datastore(args, directory):
+    # Rules, limiters and current counters in a temporary SQLite datastore,
+    # plus the warm snapshot a running server would have written for them
+    from storage import storage
+    from storage_sqlite import SQLiteStorage
+    from startup import load_from_datastore, save_snapshot
+
+    backend = SQLiteStorage(os.path.join(directory, 'postfixer.db'))
+    storage.use(backend)
+    for number in range(args.rules):
+        backend.rules.insert({
+            'rule_id': number + 1, 'position': (number + 1) * 1024.0, 'name': f"rule {number}",
+            'conditions': [{'key': 'sender', 'condition': 'regex', 'value': rf"^user{number}@.*\.example$"},
+                           {'key': 'client_address', 'condition': 'wildcard', 'value': f"10.{number % 256}.*"}],
+            'operators': ['AND'], 'action_type': 'REJECT', 'action': 'REJECT', 'custom_text': ''
+        })
+    limiters = []
+    for number in range(args.limiters):
+        limiter = {'key': 'sender', 'value': '*', 'condition': 'wildcard', 'limit': 1000,
+                   'duration': 60, 'customText': '', 'approximate': False}
+        if number % 2:
+            limiter['keys'] = ['sasl_username', 'recipient:domain']
+        backend.rate_limiters.insert(limiter)
+        limiters.append(limiter)
+    now = datetime.utcnow()
+    backend.counters.add([
+        {'limiter_id': limiters[number % len(limiters)]['_id'], 'key': 'sender',
+         'value': f"sender{number}@example.com", 'timestamp': now, 'count': 1, 'window_start': now}
+        for number in range(args.counters)
+    ] if limiters else [])
+    load_from_datastore()
+    save_snapshot(os.path.join(directory, 'warm.snapshot'))
+
+
+def bench_cold_start_child(args):
+    # One startup in a fresh process, as create_app does it before accept()
+    started = time.perf_counter()
+    from startup import warm_up
+    from ratelimiter import rate_limiter
+    from rules import loaded_rules
+    imported = time.perf_counter()
+    source = warm_up()
+    ready = time.perf_counter()
+    print(json.dumps({
+        'source': source,
+        'import_ms': (imported - started) * 1000,
+        'load_ms': (ready - imported) * 1000,
+        'process_ms': (time.time() - float(os.environ['COLD_START_SPAWNED'])) * 1000,
+        'rules': len(loaded_rules() or ()),
+        'limiters': len(rate_limiter.compiled_limiters),
+        'counters': sum(len(counters) for counters in rate_limiter.limiter_counters.values()),
+    }))
+
+
+def bench_cold_start(args):
+    # Time from spawning the server process to the point where it would accept
+    # policy connections, loading from the datastore and from a warm snapshot
+    with tempfile.TemporaryDirectory() as directory:
+        seed_datastore(args, directory)
+        env = dict(os.environ, STORAGE_BACKEND='sqlite', SQLITE_PATH=os.path.join(directory, 'postfixer.db'),
+                   WARM_SNAPSHOT_PATH=os.path.join(directory, 'warm.snapshot'))
+        print(f"{args.rules} rules, {args.limiters} rate limiters, {args.counters} counters (SQLite datastore)")
+        print(f"{'start from':<16}{'imports ms':>12}{'load ms':>12}{'spawn to ready ms':>20}")
+        for label, enabled in (('datastore', 'false'), ('warm snapshot', 'true')):
+            runs = []
+            for _ in range(args.repeat):
+                env.update(WARM_SNAPSHOT_ENABLED=enabled, COLD_START_SPAWNED=repr(time.time()))
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), 'cold_start_child'], env=env,
+                                        capture_output=True, text=True, check=True).stdout
+                runs.append(json.loads(output.splitlines()[-1]))
+            best = min(runs, key=lambda run: run['process_ms'])
+            if best['source'] != label.split()[-1] or best['rules'] != args.rules:
+                print(f"FAIL  {label}: loaded {best}")
+                sys.exit(1)
+            print(f"{label:<16}{best['import_ms']:>12.1f}{best['load_ms']:>12.1f}{best['process_ms']:>20.1f}")
+
+
+BENCHMARKS = {
+    'request_record': bench_request_record,
+    'serialize': bench_serialize,
+    'stress': bench_stress,
+    'cold_start': bench_cold_start,
+    'cold_start_child': bench_cold_start_child,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--number', type=int, default=20000, help='iterations per timing run')
+    parser.add_argument('--documents', type=int, default=100000, help='documents per response')
+    parser.add_argument('--repeat', type=int, default=3, help='timing runs, the fastest is reported')
+    parser.add_argument('--connections', type=int, default=64, help='concurrent policy connections')
+    parser.add_argument('--requests', type=int, default=500, help='requests per connection')
+    parser.add_argument('--rules', type=int, default=500, help='rules in the datastore')
+    parser.add_argument('--limiters', type=int, default=20, help='rate limiters in the datastore')
+    parser.add_argument('--counters', type=int, default=100000, help='rate limit counters in the datastore')
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import threading
+import time
+
+from storage import StorageError
+
+
+class CircuitOpenError(StorageError):
+    """Raised instead of calling the datastore while the circuit is open."""
+
+
+class CircuitBreaker:
+    """Classic closed / open / half-open breaker.
+
+    After failure_threshold consecutive failures the circuit opens and every
+    call fails immediately with CircuitOpenError.  Once reset_timeout seconds
+    have passed a single trial call is let through; its outcome closes or
+    re-opens the circuit.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=10.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                print(f"Circuit '{self.name}' closed")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_running = False
+
+    def release(self):
+        with self.lock:
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"Circuit '{self.name}' opened after {self.failures} failure(s)")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def call(self, operation, *args, **kwargs):
+        """Run operation under the breaker; a StorageError counts as a failure."""
+        if not self.allow():
+            raise CircuitOpenError(f"Circuit '{self.name}' is open")
+        try:
+            result = operation(*args, **kwargs)
+        except StorageError:
+            self.record_failure()
+            raise
+        except BaseException:
+            # Not a datastore failure (e.g. StopIteration); just free the trial slot
+            self.release()
+            raise
+        self.record_success()
+        return result
+
+    def status(self):
+        with self.lock:
+            return {'name': self.name, 'state': self.state, 'failures': self.failures}
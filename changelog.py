@@ -0,0 +1,56 @@
+import threading
+from collections import deque
+
+from bson import ObjectId
+
+from config import CHANGELOG_CAPACITY
+
+
+class ChangeLog:
+    """Bounded in-memory log of inserts, updates and deletes per collection.
+
+    Every change gets the next value of one process-wide version counter.
+    Clients remember the version of their last sync and ask for what happened
+    since; if that is older than the oldest change still kept for a
+    collection, they have to refetch it in full.  The epoch changes on every
+    restart, so versions from a previous process are never mixed up with the
+    current ones.
+    """
+
+    def __init__(self, capacities):
+        self.epoch = str(ObjectId())
+        self.version = 0
+        self.logs = {name: deque(maxlen=capacity) for name, capacity in capacities.items()}
+        # Highest version that has already been evicted from each log
+        self.floors = {name: 0 for name in capacities}
+        self.lock = threading.Lock()
+
+    def record(self, collection, op, item_id, item=None):
+        with self.lock:
+            self.version += 1
+            log = self.logs[collection]
+            if len(log) == log.maxlen:
+                self.floors[collection] = log[0]['version']
+            log.append({'version': self.version, 'op': op, 'id': str(item_id), 'item': item})
+            return self.version
+
+    def current_version(self):
+        with self.lock:
+            return self.version
+
+    def changes_since(self, collection, since):
+        """Return the changes after `since`, or None if they are no longer all kept."""
+        with self.lock:
+            if since < self.floors[collection] or since > self.version:
+                return None
+            changes = []
+            # Newest entries are at the right, so stop at the first one already seen
+            for change in reversed(self.logs[collection]):
+                if change['version'] <= since:
+                    break
+                changes.append(change)
+        changes.reverse()
+        return changes
+
+
+change_log = ChangeLog(CHANGELOG_CAPACITY)
@@ -1,4 +1,3 @@
-from pymongo import MongoClient
 import json
 from bson import ObjectId
 import re
@@ -11,14 +10,125 @@ POLICY_SERVER_PORT = int(os.environ.get('POLICY_SERVER_PORT', 5002))
 POLICY_SERVER_HOST = os.environ.get('POLICY_SERVER_HOST', '0.0.0.0')
 CORS_DOMAIN = os.environ.get('CORS_DOMAIN', 'http://localhost:3000')
 
+# Datastore: 'mongo' or 'sqlite'.  The SQLite backend keeps everything in
+# one local WAL-mode database file for single-node installs.  Connections are
+# only opened on first use, never at import.
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mongo').lower()
+SQLITE_PATH = os.environ.get('SQLITE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'postfixer.db'))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_CACHE_KB = int(os.environ.get('SQLITE_CACHE_KB', 65536))
+
 # MongoDB setup
 MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
-client = MongoClient(MONGO_URI)
-db = client['postfix_data']
-requests_collection = db['requests']
-rules_collection = db['rules']
-rate_limiters_collection = db['rate_limiters']
-rate_limit_counters_collection = db['rate_limit_counters']
+MONGO_DATABASE = os.environ.get('MONGO_DATABASE', 'postfix_data')
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 2000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 2000))
+
+# Per-operation deadlines: reads and single-document writes sit on the policy
+# path, bulk operations are only issued by background threads
+MONGO_READ_TIMEOUT_MS = int(os.environ.get('MONGO_READ_TIMEOUT_MS', 250))
+MONGO_WRITE_TIMEOUT_MS = int(os.environ.get('MONGO_WRITE_TIMEOUT_MS', 500))
+MONGO_BULK_TIMEOUT_MS = int(os.environ.get('MONGO_BULK_TIMEOUT_MS', 30000))
+
+# Circuit breakers around every datastore call
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 10))
+
+# Every policy request is answered within this budget.  When the datastore
+# cannot be used, rules are served from the last loaded copy and anything that
+# still needs MongoDB is answered with DEGRADED_ACTION (DUNNO = fail open,
+# DEFER = fail closed).
+REQUEST_BUDGET_MS = int(os.environ.get('REQUEST_BUDGET_MS', 1000))
+DEGRADED_ACTION = os.environ.get('DEGRADED_ACTION', 'DUNNO').upper()
+DEGRADED_TEXT = os.environ.get('DEGRADED_TEXT', 'Policy service temporarily unavailable')
+RULES_REFRESH_SECONDS = float(os.environ.get('RULES_REFRESH_SECONDS', 5))
+
+_READ_METHODS = ('find', 'find_one', 'count_documents', 'aggregate')
+_WRITE_METHODS = ('insert_one', 'update_one', 'replace_one', 'delete_one', 'find_one_and_update',
+                  'find_one_and_delete')
+_BULK_METHODS = ('insert_many', 'update_many', 'delete_many', 'bulk_write', 'create_index')
+OPERATION_TIMEOUTS = {
+    **{method: MONGO_READ_TIMEOUT_MS / 1000 for method in _READ_METHODS},
+    **{method: MONGO_WRITE_TIMEOUT_MS / 1000 for method in _WRITE_METHODS},
+    **{method: MONGO_BULK_TIMEOUT_MS / 1000 for method in _BULK_METHODS},
+}
+
+# The admin API and background threads (spool replay, counter writer, loaders,
+# archiver) have their own breaker and deadlines, so a slow dashboard query
+# cannot open the breaker that policy requests depend on
+MONGO_BACKGROUND_TIMEOUT_MS = int(os.environ.get('MONGO_BACKGROUND_TIMEOUT_MS', 30000))
+BACKGROUND_OPERATION_TIMEOUTS = {
+    **{method: MONGO_BACKGROUND_TIMEOUT_MS / 1000 for method in _READ_METHODS + _WRITE_METHODS},
+    **{method: MONGO_BULK_TIMEOUT_MS / 1000 for method in _BULK_METHODS},
+}
+
+# Request history: documents older than the retention window are moved from
+# the datastore into hourly columnar files below ARCHIVE_DIR
+REQUESTS_RETENTION_HOURS = int(os.environ.get('REQUESTS_RETENTION_HOURS', 24))
+ARCHIVE_ENABLED = os.environ.get('ARCHIVE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive'))
+ARCHIVE_INTERVAL_SECONDS = int(os.environ.get('ARCHIVE_INTERVAL_SECONDS', 3600))
+
+# Local write-ahead spool: request documents are appended here first and
+# replayed into the datastore in bulk, so the policy path never waits on it
+SPOOL_DIR = os.environ.get('SPOOL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spool'))
+SPOOL_SEGMENT_BYTES = int(os.environ.get('SPOOL_SEGMENT_BYTES', 16 * 1024 * 1024))
+SPOOL_MAX_BYTES = int(os.environ.get('SPOOL_MAX_BYTES', 1024 * 1024 * 1024))
+SPOOL_FSYNC_INTERVAL_MS = int(os.environ.get('SPOOL_FSYNC_INTERVAL_MS', 50))
+SPOOL_FSYNC_BATCH = int(os.environ.get('SPOOL_FSYNC_BATCH', 256))
+SPOOL_REPLAY_INTERVAL = float(os.environ.get('SPOOL_REPLAY_INTERVAL', 1))
+SPOOL_REPLAY_BATCH = int(os.environ.get('SPOOL_REPLAY_BATCH', 1000))
+
+# In-memory heavy hitters: top rate limit counters and top traffic sources
+TOP_COUNTERS_CAPACITY = int(os.environ.get('TOP_COUNTERS_CAPACITY', 100))
+TRAFFIC_TOP_FIELDS = [field.strip() for field in os.environ.get(
+    'TRAFFIC_TOP_FIELDS', 'sender,client_address,sasl_username').split(',') if field.strip()]
+TRAFFIC_TOP_CAPACITY = int(os.environ.get('TRAFFIC_TOP_CAPACITY', 1000))
+TRAFFIC_TOP_WINDOW_SECONDS = int(os.environ.get('TRAFFIC_TOP_WINDOW_SECONDS', 3600))
+
+# Approximate rate limiters count in windowed Count-Min Sketches.  A sketch
+# overcounts by at most APPROX_ERROR_RATE times the traffic in the window
+# (with probability 1 - APPROX_DELTA); keys reaching APPROX_PROMOTE_RATIO of
+# their limit switch to an exact counter.
+APPROX_ERROR_RATE = float(os.environ.get('APPROX_ERROR_RATE', 0.001))
+APPROX_DELTA = float(os.environ.get('APPROX_DELTA', 0.01))
+APPROX_PROMOTE_RATIO = float(os.environ.get('APPROX_PROMOTE_RATIO', 0.8))
+
+# Shared state of the policy threads: rate limit counters are split over
+# COUNTER_STRIPES locks and added to the shared counters in the datastore every
+# COUNTER_FLUSH_INTERVAL_MS, which bounds how far servers can run past a limit
+# together.  A limiter keeps at most COUNTER_MAX_KEYS exact counters in memory;
+# further keys are counted in a Count-Min sketch.
+# the recent requests shown by /api/data and the traffic sketches are split
+# over THREAD_STRIPES per-thread parts
+COUNTER_STRIPES = int(os.environ.get('COUNTER_STRIPES', 64))
+COUNTER_FLUSH_INTERVAL_MS = int(os.environ.get('COUNTER_FLUSH_INTERVAL_MS', 1000))
+COUNTER_MAX_KEYS = int(os.environ.get('COUNTER_MAX_KEYS', 100000))
+RECENT_REQUESTS_CAPACITY = int(os.environ.get('RECENT_REQUESTS_CAPACITY', 10000))
+RECENT_REQUESTS_MAX_AGE_SECONDS = int(os.environ.get('RECENT_REQUESTS_MAX_AGE_SECONDS', 3600))
+THREAD_STRIPES = int(os.environ.get('THREAD_STRIPES', 16))
+
+# Warm start: the rule set, rate limiters and their counters are saved to
+# WARM_SNAPSHOT_PATH every WARM_SNAPSHOT_INTERVAL_SECONDS and on exit.  A
+# snapshot younger than WARM_SNAPSHOT_MAX_AGE_SECONDS is loaded at startup, so
+# policy connections are accepted before the datastore has been read.
+WARM_SNAPSHOT_ENABLED = os.environ.get('WARM_SNAPSHOT_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+WARM_SNAPSHOT_PATH = os.environ.get(
+    'WARM_SNAPSHOT_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'warm.snapshot'))
+WARM_SNAPSHOT_INTERVAL_SECONDS = int(os.environ.get('WARM_SNAPSHOT_INTERVAL_SECONDS', 30))
+WARM_SNAPSHOT_MAX_AGE_SECONDS = int(os.environ.get('WARM_SNAPSHOT_MAX_AGE_SECONDS', 600))
+# Upper bound for reading rules, rate limiters and counters from the datastore
+# before the policy socket is opened
+STARTUP_DATASTORE_TIMEOUT_MS = int(os.environ.get('STARTUP_DATASTORE_TIMEOUT_MS', 5000))
+# Rate limiters that could not be read at startup are retried this often
+LIMITER_LOAD_RETRY_SECONDS = float(os.environ.get('LIMITER_LOAD_RETRY_SECONDS', 5))
+
+# Delta sync for the dashboard: number of changes kept per collection
+CHANGELOG_CAPACITY = {
+    'rules': int(os.environ.get('CHANGELOG_RULES_CAPACITY', 10000)),
+    'rate_limiters': int(os.environ.get('CHANGELOG_RATE_LIMITERS_CAPACITY', 1000)),
+    'requests': int(os.environ.get('CHANGELOG_REQUESTS_CAPACITY', 50000)),
+}
 
 # Define valid action types
 VALID_ACTIONS = {
@@ -0,0 +1,110 @@
+import hashlib
+import math
+import threading
+import time
+from array import array
+
+# Cells are 64-bit so weighted limiters (bytes per window) cannot overflow
+CELL_TYPE = 'Q'
+CELL_MAX = 2 ** 64 - 1
+
+
+class CountMinSketch:
+    """Count-Min Sketch with conservative update.
+
+    With width = ceil(e / epsilon) and depth = ceil(ln(1 / delta)) an estimate
+    never undercounts and exceeds the true count by more than epsilon * total
+    with probability at most delta.  Conservative update only raises the rows
+    that are at the current minimum, which keeps the overestimate well below
+    that bound for skewed traffic.
+    """
+
+    def __init__(self, epsilon=0.001, delta=0.01):
+        self.width = max(1, math.ceil(math.e / epsilon))
+        self.depth = max(1, math.ceil(math.log(1 / delta)))
+        self.table = array(CELL_TYPE, bytes(8 * self.width * self.depth))
+        self.total = 0
+
+    def _cells(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        width = self.width
+        return [row * width + (h1 + row * h2) % width for row in range(self.depth)]
+
+    def add(self, key, weight=1):
+        """Add weight to key and return its new estimate."""
+        return self._add_cells(self._cells(key), weight)
+
+    def estimate(self, key):
+        return self._estimate_cells(self._cells(key))
+
+    def _add_cells(self, cells, weight):
+        table = self.table
+        estimate = min(min(table[cell] for cell in cells) + weight, CELL_MAX)
+        for cell in cells:
+            if table[cell] < estimate:
+                table[cell] = estimate
+        self.total += weight
+        return estimate
+
+    def _estimate_cells(self, cells):
+        table = self.table
+        return min(table[cell] for cell in cells)
+
+    def clear(self):
+        self.table = array(CELL_TYPE, bytes(8 * self.width * self.depth))
+        self.total = 0
+
+    def memory_bytes(self):
+        return self.table.itemsize * len(self.table)
+
+
+class WindowedCountMin:
+    """Sliding-window counts built from a ring of Count-Min sketches.
+
+    The window is split into `buckets` slices of equal length; each slice has
+    its own sketch and the estimate for a key is the sum over the slices still
+    inside the window.  Memory is fixed at buckets * width * depth counters no
+    matter how many distinct keys are seen.
+    """
+
+    def __init__(self, window_seconds, epsilon=0.001, delta=0.01, buckets=6):
+        self.bucket_seconds = window_seconds / buckets
+        self.sketches = [CountMinSketch(epsilon, delta) for _ in range(buckets)]
+        self.current_slot = self._slot(time.time())
+        self.lock = threading.Lock()
+
+    def _slot(self, now):
+        return int(now // self.bucket_seconds)
+
+    def _advance(self, now):
+        slot = self._slot(now)
+        if slot == self.current_slot:
+            return
+        # Clear every bucket that has fallen out of the window since the last call
+        for stale in range(self.current_slot + 1, min(slot, self.current_slot + len(self.sketches)) + 1):
+            self.sketches[stale % len(self.sketches)].clear()
+        if slot - self.current_slot > len(self.sketches):
+            for sketch in self.sketches:
+                sketch.clear()
+        self.current_slot = slot
+
+    def add(self, key, weight=1, now=None):
+        """Add weight to key in the current slice and return the windowed estimate."""
+        with self.lock:
+            self._advance(time.time() if now is None else now)
+            current = self.sketches[self.current_slot % len(self.sketches)]
+            # All slices share width and depth, so the key is hashed only once
+            cells = current._cells(key)
+            current._add_cells(cells, weight)
+            return sum(sketch._estimate_cells(cells) for sketch in self.sketches)
+
+    def estimate(self, key, now=None):
+        with self.lock:
+            self._advance(time.time() if now is None else now)
+            cells = self.sketches[0]._cells(key)
+            return sum(sketch._estimate_cells(cells) for sketch in self.sketches)
+
+    def memory_bytes(self):
+        return sum(sketch.memory_bytes() for sketch in self.sketches)
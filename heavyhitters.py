@@ -0,0 +1,194 @@
+import heapq
+import threading
+import time
+
+from striped import thread_stripe
+
+
+class TopCounters:
+    """Bounded top-K of keys whose exact count is known by the caller.
+
+    update() overwrites a key's count; when the structure is full a new key
+    only gets in if its count beats the current minimum, which is then
+    evicted.  A min-heap with lazy invalidation keeps updates at O(log k).
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.entries = {}  # key -> (count, info)
+        self.heap = []  # (count, sequence, key); stale entries are skipped
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def _push(self, key, count):
+        self.sequence += 1
+        heapq.heappush(self.heap, (count, self.sequence, key))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(entry[0], i, key) for i, (key, entry) in enumerate(self.entries.items())]
+            heapq.heapify(self.heap)
+
+    def _pop_min(self):
+        while self.heap:
+            count, _, key = heapq.heappop(self.heap)
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == count:
+                del self.entries[key]
+                return count
+        return None
+
+    def _peek_min(self):
+        while self.heap:
+            count, _, key = self.heap[0]
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == count:
+                return count
+            heapq.heappop(self.heap)
+        return None
+
+    def update(self, key, count, info=None):
+        with self.lock:
+            if key not in self.entries and len(self.entries) >= self.capacity:
+                if count <= self._peek_min():
+                    return
+                self._pop_min()
+            self.entries[key] = (count, info)
+            self._push(key, count)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def discard_where(self, predicate):
+        with self.lock:
+            for key in [key for key, (_, info) in self.entries.items() if predicate(key, info)]:
+                del self.entries[key]
+
+    def top(self, n=10):
+        """Return [(key, count, info)] with the highest counts first."""
+        with self.lock:
+            items = list(self.entries.items())
+        return [(key, count, info) for key, (count, info) in heapq.nlargest(n, items, key=lambda item: item[1][0])]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SpaceSaving:
+    """Space-Saving sketch (Metwally et al.) for approximate heavy hitters.
+
+    Tracks at most `capacity` keys.  An unseen key replaces the key with the
+    smallest count and inherits that count as its error bound, so every key
+    whose true frequency exceeds total / capacity is guaranteed to be present.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}  # key -> [count, error]
+        self.heap = []
+        self.sequence = 0
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def _push(self, key, count):
+        self.sequence += 1
+        heapq.heappush(self.heap, (count, self.sequence, key))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(entry[0], i, key) for i, (key, entry) in enumerate(self.counts.items())]
+            heapq.heapify(self.heap)
+
+    def _pop_min(self):
+        while self.heap:
+            count, _, key = heapq.heappop(self.heap)
+            entry = self.counts.get(key)
+            if entry is not None and entry[0] == count:
+                del self.counts[key]
+                return count
+        return 0
+
+    def add(self, key, weight=1):
+        with self.lock:
+            self.total += weight
+            entry = self.counts.get(key)
+            if entry is not None:
+                entry[0] += weight
+            elif len(self.counts) < self.capacity:
+                entry = self.counts[key] = [weight, 0]
+            else:
+                floor = self._pop_min()
+                entry = self.counts[key] = [floor + weight, floor]
+            self._push(key, entry[0])
+
+    def top(self, n=10):
+        """Return [(key, count, error)]; the true count lies in [count - error, count]."""
+        with self.lock:
+            items = [(key, count, error) for key, (count, error) in self.counts.items()]
+        return heapq.nlargest(n, items, key=lambda item: item[1])
+
+    def merge(self, other):
+        with other.lock:
+            items = [(key, count, error) for key, (count, error) in other.counts.items()]
+            total = other.total
+        with self.lock:
+            self.total += total
+            for key, count, error in items:
+                entry = self.counts.get(key)
+                if entry is not None:
+                    entry[0] += count
+                    entry[1] += error
+                else:
+                    entry = self.counts[key] = [count, error]
+                self._push(key, entry[0])
+            while len(self.counts) > self.capacity:
+                self._pop_min()
+
+    def __len__(self):
+        return len(self.counts)
+
+
+class TrafficHitters:
+    """Top values per request attribute over a sliding pair of windows.
+
+    Each tracked field has a current and a previous Space-Saving sketch; the
+    current one is rotated every window_seconds and queries merge both, so
+    results cover between one and two windows of traffic.  With stripes > 1
+    every thread counts into its own set of sketches, which are merged when
+    queried, so policy threads do not contend on one sketch lock.
+    """
+
+    def __init__(self, fields, capacity=1000, window_seconds=3600, stripes=1):
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        self.window_seconds = window_seconds
+        self.stripes = stripes
+        self.window_start = time.monotonic()
+        self.current = self._new_window()
+        self.previous = self._new_window()
+        self.lock = threading.Lock()
+
+    def _new_window(self):
+        return [{field: SpaceSaving(self.capacity) for field in self.fields} for _ in range(self.stripes)]
+
+    def _rotate(self, now):
+        with self.lock:
+            if now - self.window_start < self.window_seconds:
+                return
+            self.previous = self.current
+            self.current = self._new_window()
+            self.window_start = now
+
+    def observe(self, parsed_data):
+        now = time.monotonic()
+        if now - self.window_start >= self.window_seconds:
+            self._rotate(now)
+        current = self.current[thread_stripe(self.stripes)]
+        for field in self.fields:
+            value = parsed_data.get(field)
+            if value:
+                current[field].add(value)
+
+    def top(self, field, n=10):
+        merged = SpaceSaving(self.capacity)
+        for window in (self.previous, self.current):
+            for stripe in window:
+                merged.merge(stripe[field])
+        return [{'value': key, 'count': count, 'error': error} for key, count, error in merged.top(n)]
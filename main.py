@@ -2,165 +2,70 @@ import socket
 import threading
 import time
 import traceback
-import json
-import pymongo
 import logging
 
 from flask import Flask, jsonify, request
 from flask_socketio import SocketIO, join_room, leave_room
 from flask_cors import CORS
 
-from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
 from bson import ObjectId
 
-from rules import validate_rule, ensure_rule_ids, apply_rules, determine_final_action
-from ratelimiter import rate_limiter
-from config import JSONEncoder, requests_collection, rules_collection, KEY_OPTIONS
+from rules import validate_rule
+from rules import create_new_rule, update_rule, delete_rule, update_rule_order, get_rules, start_rule_refresher
+from ratelimiter import rate_limiter, validate_limiter_keys
+from config import KEY_OPTIONS, TRAFFIC_TOP_FIELDS
+from config import CHANGELOG_CAPACITY
+from config import REQUESTS_RETENTION_HOURS, ARCHIVE_ENABLED, ARCHIVE_INTERVAL_SECONDS
 from config import CORS_DOMAIN, FLASK_SOCKET_LISTEN_PORT, FLASK_SOCKET_LISTEN_HOST, POLICY_SERVER_PORT, POLICY_SERVER_HOST
-from utils import determine_version, parse_data, find_free_port
+from utils import find_free_port
+import serialization
+from serialization import FastJSONProvider, BSON_MIMETYPE, dumps_bytes, bson_bytes, wants_bson
+import archive
+import policy
+from policy import data_storage, traffic_hitters, handle_client
+from spool import request_spool
+from changelog import change_log
+from storage import storage
+from startup import warm_up, start_snapshot_writer
 
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 CORS(app, resources={r"/api/*": {"origins": CORS_DOMAIN}})
-socketio = SocketIO(app, cors_allowed_origins=CORS_DOMAIN, async_mode='eventlet')
+socketio = SocketIO(app, cors_allowed_origins=CORS_DOMAIN, async_mode='eventlet', json=serialization)
 
 # Add a global variable to track server readiness
 server_ready = False
-
-# Shared data storage
-class TimedOrderedDict(OrderedDict):
-    def __init__(self, max_age_seconds):
-        self.max_age_seconds = max_age_seconds
-        super().__init__()
-
-    def __setitem__(self, key, value):
-        self.cleanup()
-        super().__setitem__(key, (value, time.time()))
-
-    def cleanup(self):
-        now = time.time()
-        for key, (value, timestamp) in list(self.items()):
-            if now - timestamp > self.max_age_seconds:
-                del self[key]
-
-    def to_dict(self):
-        return {k: v for k, (v, _) in self.items()}
-
-data_storage = TimedOrderedDict(max_age_seconds=3600)  # Keep data for 1 hour
-current_version = "Unknown"
+# Where the initial rules and rate limiters came from and how long it took
+startup_status = {}
 
 def cleanup_mongodb():
-    cutoff_time = datetime.now(timezone.utc) - timedelta(hours=24)
-    requests_collection.delete_many({"timestamp": {"$lt": cutoff_time}})
+    cutoff_time = datetime.now(timezone.utc) - timedelta(hours=REQUESTS_RETENTION_HOURS)
+    storage.requests.ensure_indexes()
+    if ARCHIVE_ENABLED:
+        # Expired requests are moved to the columnar archive instead of being dropped
+        archive.archive_expired(cutoff_time)
+    else:
+        storage.requests.delete_older_than(cutoff_time)
 
 def periodic_mongodb_cleanup():
     with app.app_context():
         while True:
-            cleanup_mongodb()
-            time.sleep(7200)
-
-def store_in_mongodb(parsed_data):
-    parsed_data['timestamp'] = datetime.now(timezone.utc)
-    rule_results = apply_rules(parsed_data)
-    parsed_data['rule_results'] = rule_results
-    
-    # Determine the final action based on the first (and only) matching rule
-    final_action = determine_final_action(rule_results)
-    parsed_data['final_action'] = final_action
-    
-    # Remove _id if it exists to let MongoDB generate a new one
-    parsed_data.pop('_id', None)
-    
-    try:
-        result = requests_collection.insert_one(parsed_data)
-        parsed_data['_id'] = str(result.inserted_id)
-    except pymongo.errors.DuplicateKeyError:
-        # If a duplicate key error occurs, update the existing document
-        existing_doc = requests_collection.find_one({'_id': parsed_data.get('_id')})
-        if existing_doc:
-            requests_collection.replace_one({'_id': existing_doc['_id']}, parsed_data)
-            parsed_data['_id'] = str(existing_doc['_id'])
-        else:
-            # If we can't find the existing document, generate a new _id
-            parsed_data['_id'] = str(ObjectId())
-            requests_collection.insert_one(parsed_data)
-    
-    # bugfix json serializable error
-    parsed_data['timestamp'] = parsed_data['timestamp'].isoformat()
-
-    return final_action
+            try:
+                cleanup_mongodb()
+            except Exception as e:
+                print(f"Error in cleanup_mongodb: {str(e)}")
+                print(traceback.format_exc())
+            time.sleep(ARCHIVE_INTERVAL_SECONDS if ARCHIVE_ENABLED else 7200)
 
-def handle_client(client_socket, address):
-    print(f"Connection from {address} has been established.")
-    buffer = ""
-    while True:
-        try:
-            chunk = client_socket.recv(1024)
-            if not chunk:
-                print(f"Connection closed by client {address}")
-                break
-            buffer += chunk.decode('utf-8')
-            if buffer.endswith('\n\n'):
-                # Check if the request is valid
-                if "request=smtpd_access_policy" not in buffer:
-                    print("Invalid request: missing 'request=smtpd_access_policy'")
-                    response = "REJECT Invalid request\n\n"
-                    client_socket.sendall(response.encode('utf-8'))
-                    buffer = ""
-                    continue
-
-                parsed_data = parse_data(buffer)
-                instance_data = parsed_data.copy()
-
-                current_version = determine_version(instance_data)
-
-                # Apply rules first
-                final_action = store_in_mongodb(instance_data)
-                
-                # If no rule was applied (final_action is None), check rate limit
-                if final_action is None:
-                    if not rate_limiter.check_rate_limit(instance_data):
-                        custom_text = rate_limiter.get_custom_text(instance_data)
-                        if custom_text:
-                            final_action = f"REJECT {custom_text}"
-                        else:
-                            final_action = "REJECT 400: Rate limit exceeded"
-                        print("Rate limit exceeded")
-                
-                # Always update the final_action in instance_data
-                instance_data['final_action'] = final_action if final_action else "DUNNO"
-                
-                # Extract custom text if present
-                custom_text = instance_data.get('custom_text', '')
-                
-                data_storage.update(instance_data)
-                
-                # Always emit the SocketIO event, regardless of the action
-                with app.app_context():
-                    socketio.emit('new_data', {
-                        'data': instance_data,
-                        'version': current_version,
-                        'action': instance_data['final_action']
-                    }, room='updates')
-                    logging.info(f"Emitted new_data event to 'updates' room: {instance_data}")
-
-                # Send response back to the socket client
-                response = f"{instance_data['final_action']} {custom_text}\n\n".strip() + "\n\n"
-                client_socket.sendall(response.encode('utf-8'))
-                
-                buffer = ""
-        except Exception as e:
-            print(f"Error processing data from {address}: {str(e)}")
-            print(traceback.format_exc())
-            break
-    client_socket.close()
+def publish_request(event):
+    with app.app_context():
+        socketio.emit('new_data', event, room='updates')
+        logging.info("Emitted new_data event to 'updates' room: %s", event['data'])
 
 def socket_listener():
     with app.app_context():
-        global current_version
-
-        
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         
@@ -182,7 +87,7 @@ def socket_listener():
         while True:
             try:
                 client_socket, address = server_socket.accept()
-                client_thread = threading.Thread(target=handle_client, args=(client_socket, address))
+                client_thread = threading.Thread(target=handle_client, args=(client_socket, address, publish_request))
                 client_thread.start()
             except Exception as e:
                 print(f"An error occurred in socket_listener: {str(e)}")
@@ -191,10 +96,11 @@ def socket_listener():
 
 def initialize_server():
     global server_ready
-    # Perform any necessary initialization here
-    time.sleep(2)  # Give the server a moment to fully initialize
+    started = time.perf_counter()
+    source = warm_up()
+    startup_status.update(source=source, seconds=round(time.perf_counter() - started, 3))
     server_ready = True
-    print("Server is now ready to accept requests")
+    print(f"Server is now ready to accept requests (loaded from {source} in {startup_status['seconds']}s)")
 
 @app.route('/api/server_status')
 def server_status():
@@ -206,6 +112,9 @@ def check_server_ready():
         return jsonify({"error": "Server is still initializing"}), 503
     return None
 
+# Request fields /api/request_stats can group by and /api/data can select
+STATS_FIELDS = KEY_OPTIONS + ['final_action']
+
 @app.route('/api/data', methods=['GET', 'POST'])
 def get_data():
     status = check_server_ready()
@@ -216,9 +125,17 @@ def get_data():
             data = request.json
             start_time = data.get('start_time')
             end_time = data.get('end_time')
+            fields = data.get('fields')
         else:
             start_time = request.args.get('start_time')
             end_time = request.args.get('end_time')
+            fields = request.args.get('fields')
+
+        # Optional column selection, e.g. fields=sender,recipient,final_action
+        if isinstance(fields, str):
+            fields = [field.strip() for field in fields.split(',') if field.strip()]
+        if fields is not None and (not isinstance(fields, list) or any(field not in STATS_FIELDS for field in fields)):
+            return jsonify({'error': f"Unknown field. Fields must be among {', '.join(STATS_FIELDS)}"}), 400
 
         print(f"Received start_time: {start_time}, end_time: {end_time}")  # Debug print
 
@@ -242,43 +159,86 @@ def get_data():
         if start_time >= end_time:
             return jsonify({'error': 'start_time must be before end_time'}), 400
 
-        # Get recent data from TimedOrderedDict
-        recent_data = {}
-        now = time.time()
-        for key, (value, timestamp) in data_storage.items():
-            if start_time.timestamp() <= timestamp <= end_time.timestamp():
-                recent_data[key] = value
-
-        # Fetch data from MongoDB
-        mongo_data = list(requests_collection.find(
-            {
-                "timestamp": {
-                    "$gte": start_time,
-                    "$lte": end_time
-                }
-            }
-        ).sort("timestamp", -1))
-
-        # Format timestamps and convert ObjectId to string
-        for item in mongo_data:
-            if 'timestamp' in item:
-                item['timestamp'] = item['timestamp'].isoformat()
-            else:
-                print(f"Warning: timestamp missing for item {item.get('_id', 'unknown')}")
-            item['_id'] = str(item['_id']) 
+        # Recent requests kept in memory, newest first
+        recent_data = {
+            key: value for key, value, _ in data_storage.items(start_time.timestamp(), end_time.timestamp())
+        }
+
+        # Fetch data from the datastore; BSON clients get the documents exactly
+        # as they are stored, without decoding and re-encoding each one
+        send_bson = wants_bson(request)
+        mongo_data = storage.requests.find_range(start_time, end_time, fields, raw=send_bson)
+
+        # Older ranges live in the hourly archive files
+        mongo_data.extend(query_archive(start_time, end_time, mongo_data, fields))
 
-        return json.dumps({
+        payload = {
             'recent_data': recent_data,
             'historical_data': mongo_data,
-            'version': current_version,
+            'version': policy.current_version,
             'start_time': start_time.isoformat(),
             'end_time': end_time.isoformat()
-        }, cls=JSONEncoder), 200, {'Content-Type': 'application/json'}
+        }
+        # Timestamps and ObjectIds are converted by the encoder itself
+        if send_bson:
+            return bson_bytes(payload), 200, {'Content-Type': BSON_MIMETYPE}
+        return dumps_bytes(payload), 200, {'Content-Type': 'application/json'}
 
     except Exception as e:
         print(f"Error in get_data: {str(e)}")
         return jsonify(error=str(e)), 500
 
+def query_archive(start_time, end_time, mongo_data, fields=None):
+    if not ARCHIVE_ENABLED:
+        return []
+    archived_until = datetime.now(timezone.utc) - timedelta(hours=REQUESTS_RETENTION_HOURS)
+    if start_time >= archived_until:
+        return []
+    # An hour that is being archived right now can briefly be in both stores
+    seen_ids = {str(item['_id']) for item in mongo_data}
+    columns = fields + ['_id'] if fields else None
+    return [item for item in archive.query(start_time, end_time, columns)
+            if str(item['_id']) not in seen_ids]
+
+
+@app.route('/api/request_stats', methods=['GET'])
+def get_request_stats():
+    status = check_server_ready()
+    if status:
+        return status
+    try:
+        field = request.args.get('field', 'final_action')
+        if field not in STATS_FIELDS:
+            return jsonify({'error': f"Unknown field. Must be one of {', '.join(STATS_FIELDS)}"}), 400
+        start_time = request.args.get('start_time')
+        end_time = request.args.get('end_time')
+        try:
+            end_time = datetime.fromisoformat(end_time.replace('Z', '+00:00')) if end_time else datetime.now(timezone.utc)
+            start_time = datetime.fromisoformat(start_time.replace('Z', '+00:00')) if start_time else end_time - timedelta(hours=24)
+        except ValueError:
+            return jsonify({'error': 'Invalid datetime format. Use ISO format (YYYY-MM-DDTHH:MM:SS)'}), 400
+
+        counts = storage.requests.count_by(field, start_time, end_time)
+
+        archived_until = datetime.now(timezone.utc) - timedelta(hours=REQUESTS_RETENTION_HOURS)
+        if ARCHIVE_ENABLED and start_time < archived_until:
+            # As in get_data, a request that is in both stores while its hour
+            # is being archived is only counted from the datastore
+            not_archived = {str(item['_id']) for item in storage.requests.find_range(
+                start_time, min(end_time, archived_until), ['_id'])}
+            for value, count in archive.count_by(field, start_time, end_time, skip_ids=not_archived).items():
+                counts[str(value)] = counts.get(str(value), 0) + count
+
+        return jsonify({
+            'field': field,
+            'counts': counts,
+            'start_time': start_time.isoformat(),
+            'end_time': end_time.isoformat()
+        }), 200
+    except Exception as e:
+        print(f"Error in get_request_stats: {str(e)}")
+        return jsonify(error=str(e)), 500
+
 @app.route('/api/rules', methods=['GET', 'POST', 'PUT', 'DELETE'])
 def manage_rules():
     status = check_server_ready()
@@ -286,16 +246,16 @@ def manage_rules():
         return status
     try:
         if request.method == 'GET':
-            rules = list(rules_collection.find())
-            return jsonify([{**rule, '_id': str(rule['_id'])} for rule in rules])
+            return jsonify(get_rules())
         
         elif request.method == 'POST':
             new_rule = request.json
             
             if not validate_rule(new_rule):
                 return jsonify({'error': 'Invalid rule format'}), 400
-            result = rules_collection.insert_one(new_rule)
-            return jsonify({'message': 'Rule created', 'id': str(result.inserted_id)}), 201
+            new_rule = create_new_rule(new_rule)
+            change_log.record('rules', 'insert', new_rule['_id'], new_rule)
+            return jsonify({'message': 'Rule created', 'id': str(new_rule['_id']), 'rule_id': new_rule['rule_id']}), 201
         
         elif request.method == 'PUT':
             rule_id = request.json.get('_id')
@@ -306,10 +266,11 @@ def manage_rules():
             if not validate_rule(updated_rule):
                 return jsonify({'error': 'Invalid rule format'}), 400
             
-            del updated_rule['_id']
-            result = rules_collection.update_one({'_id': ObjectId(rule_id)}, {'$set': updated_rule})
+            rule = storage.rules.get_by_id(rule_id)
+            rule = update_rule(rule['rule_id'], updated_rule) if rule else None
             
-            if result.modified_count:
+            if rule:
+                change_log.record('rules', 'update', rule['_id'], rule)
                 return jsonify({'message': 'Rule updated'})
             else:
                 return jsonify({'error': 'Rule not found'}), 404
@@ -319,9 +280,11 @@ def manage_rules():
             if not rule_id:
                 return jsonify({'error': 'No rule ID provided'}), 400
             
-            result = rules_collection.delete_one({'_id': ObjectId(rule_id)})
+            rule = storage.rules.get_by_id(rule_id)
+            rule = delete_rule(rule['rule_id']) if rule else None
             
-            if result.deleted_count:
+            if rule:
+                change_log.record('rules', 'delete', rule['_id'])
                 return jsonify({'message': 'Rule deleted'})
             else:
                 return jsonify({'error': 'Rule not found'}), 404
@@ -330,25 +293,18 @@ def manage_rules():
         return jsonify(error=str(e)), 500
 
 
-@app.route('/api/rules/<rule_id>', methods=['PUT', 'DELETE'])
+@app.route('/api/rules/<int:rule_id>', methods=['PUT', 'DELETE'])
 def manage_rule(rule_id):
     status = check_server_ready()
     if status:
         return status
     if request.method == 'PUT':
         try:
-            updated_rule = request.json
-            # Remove _id from the update data if it exists
-            if '_id' in updated_rule:
-                del updated_rule['_id']
-            
-            result = rules_collection.update_one(
-                {'_id': ObjectId(rule_id)},
-                {'$set': updated_rule}
-            )
+            rule = update_rule(rule_id, request.json)
             
-            if result.modified_count == 0:
-                return jsonify({"error": "Rule not found or no changes made"}), 404
+            if rule is None:
+                return jsonify({"error": f"Rule with ID {rule_id} not found"}), 404
+            change_log.record('rules', 'update', rule['_id'], rule)
             
             return jsonify({"message": "Rule updated successfully"}), 200
         except Exception as e:
@@ -357,10 +313,11 @@ def manage_rule(rule_id):
     elif request.method == 'DELETE':
         try:
             print(f"Deleting rule with ID: {rule_id}")
-            result = rules_collection.delete_one({'rule_id': int(rule_id)})
+            rule = delete_rule(rule_id)
             
-            if result.deleted_count == 0:
+            if rule is None:
                 return jsonify({"error": f"Rule with ID {rule_id} not found"}), 404
+            change_log.record('rules', 'delete', rule['_id'])
             
             return jsonify({"message": f"Rule with ID {rule_id} deleted successfully"}), 200
         except Exception as e:
@@ -368,6 +325,34 @@ def manage_rule(rule_id):
             return jsonify({"error": str(e)}), 500
 
 
+@app.route('/api/changes', methods=['GET'])
+def get_changes():
+    """Delta sync: everything that changed in the given collections since a version.
+
+    Collections whose changes are no longer fully kept (or whose client is
+    from another epoch) are listed in `reset` and must be refetched in full.
+    Call without `since` to learn the current version before a full fetch.
+    """
+    status = check_server_ready()
+    if status:
+        return status
+    collections = request.args.get('collections', ','.join(CHANGELOG_CAPACITY)).split(',')
+    unknown = [name for name in collections if name not in CHANGELOG_CAPACITY]
+    if unknown:
+        return jsonify({'error': f"Unknown collections: {', '.join(unknown)}"}), 400
+    since = request.args.get('since', type=int)
+    same_epoch = request.args.get('epoch') == change_log.epoch
+
+    version = change_log.current_version()
+    changes = {}
+    reset = []
+    for name in collections:
+        collection_changes = change_log.changes_since(name, since) if since is not None and same_epoch else None
+        if collection_changes is None:
+            reset.append(name)
+        else:
+            changes[name] = [change for change in collection_changes if change['version'] <= version]
+    return jsonify({'epoch': change_log.epoch, 'version': version, 'changes': changes, 'reset': reset})
 
 @app.route('/api/key_options', methods=['GET'])
 def get_key_options():
@@ -376,36 +361,30 @@ def get_key_options():
         return status
     return jsonify(KEY_OPTIONS)
 
-from rules import update_rule_order, get_rules
-
 @app.route('/api/rules/<int:rule_id>/move', methods=['PUT'])
 def move_rule(rule_id):
+    """Move a rule directly before or after another one: {"before": rule_id} or {"after": rule_id}."""
     status = check_server_ready()
     if status:
         return status
     try:
-        new_position = request.json.get('new_position')
-        if new_position is None:
-            return jsonify({"error": "New position not provided"}), 400
-        
-        new_position = int(new_position)
-        
-        # Validate that rule_id exists
-        rule = rules_collection.find_one({'rule_id': rule_id})
-        if not rule:
-            return jsonify({"error": f"Rule with id {rule_id} not found"}), 404
-        
-        # Validate that new_position is valid
-        max_position = rules_collection.count_documents({})
-        if new_position < 1 or new_position > max_position:
-            return jsonify({"error": f"Invalid new position. Must be between 1 and {max_position}"}), 400
-        
-        update_rule_order(rule_id, new_position)
+        before = request.json.get('before')
+        after = request.json.get('after')
+        if (before is None) == (after is None):
+            return jsonify({"error": "Provide either 'before' or 'after'"}), 400
+        if rule_id in (before, after):
+            return jsonify({"error": "A rule cannot be moved relative to itself"}), 400
         
-        # Fetch updated rules after moving
-        updated_rules = get_rules()
+        rule = update_rule_order(rule_id, before=before, after=after)
+        if rule is None:
+            return jsonify({"error": f"Rule {rule_id} or {before if after is None else after} not found"}), 404
+        version = change_log.record('rules', 'update', rule['_id'], rule)
         
-        return jsonify({"message": "Rule moved successfully", "rules": updated_rules}), 200
+        return jsonify({
+            "message": "Rule moved successfully",
+            "changes": [rule],
+            "version": version
+        }), 200
     except Exception as e:
         print(f"Error moving rule: {str(e)}")
         import traceback
@@ -433,12 +412,31 @@ def manage_rate_limiters():
         return jsonify(rate_limiter.get_rate_limiters())
     elif request.method == 'POST':
         data = request.json
+        if not valid_error_rate(data.get('error_rate')):
+            return jsonify({'error': 'error_rate must be between 0 and 1'}), 400
+        keys = data.get('keys')
+        key = data.get('key') or '+'.join(keys or [])
+        try:
+            validate_limiter_keys(key, keys, data.get('weight'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         limiter_id = rate_limiter.create_rate_limiter(
-            data['key'], data['value'], data['condition'], 
-            int(data['limit']), int(data['duration']), data['customText']
+            key, data['value'], data['condition'], 
+            int(data['limit']), int(data['duration']), data['customText'],
+            data.get('approximate', False), data.get('error_rate'),
+            keys, data.get('weight')
         )
+        change_log.record('rate_limiters', 'insert', limiter_id, rate_limiter.get_rate_limiter(limiter_id))
         return jsonify({'id': limiter_id}), 201
 
+def valid_error_rate(error_rate):
+    if error_rate in (None, ''):
+        return True
+    try:
+        return 0 < float(error_rate) < 1
+    except (TypeError, ValueError):
+        return False
+
 @app.route('/api/rate_limiters/<limiter_id>', methods=['PUT', 'DELETE'])
 def update_delete_rate_limiter(limiter_id):
     status = check_server_ready()
@@ -446,13 +444,32 @@ def update_delete_rate_limiter(limiter_id):
         return status
     if request.method == 'PUT':
         data = request.json
+        if not valid_error_rate(data.get('error_rate')):
+            return jsonify({'error': 'error_rate must be between 0 and 1'}), 400
+        current = rate_limiter.get_rate_limiter(limiter_id)
+        if current is None:
+            return jsonify({'error': 'Rate limiter not found'}), 404
+        # Compound keys are kept unless the update replaces them
+        keys = data['keys'] if 'keys' in data else current.get('keys')
+        if keys and isinstance(keys, list):
+            key = '+'.join(str(spec) for spec in keys)
+        else:
+            key = data.get('key') or current['key']
+        try:
+            validate_limiter_keys(key, keys, data.get('weight'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         rate_limiter.update_rate_limiter(
             limiter_id, data['value'], data['condition'], 
-            int(data['limit']), int(data['duration']), data['customText']
+            int(data['limit']), int(data['duration']), data['customText'],
+            data.get('approximate', False), data.get('error_rate'),
+            keys, data.get('weight'), key
         )
+        change_log.record('rate_limiters', 'update', limiter_id, rate_limiter.get_rate_limiter(limiter_id))
         return jsonify({'message': 'Rate limiter updated successfully'})
     elif request.method == 'DELETE':
         rate_limiter.delete_rate_limiter(limiter_id)
+        change_log.record('rate_limiters', 'delete', limiter_id)
         return jsonify({'message': 'Rate limiter deleted successfully'})
     
 @app.route('/api/top_rate_limit_counters')
@@ -463,11 +480,27 @@ def get_top_rate_limit_counters():
     limit = request.args.get('limit', default=10, type=int)
     max_limit = 50  # Maximum allowed limit
     limit = min(limit, max_limit)  # Ensure limit doesn't exceed max_limit
-    return jsonify(rate_limiter.get_top_rate_limit_counters(limit))
+    limiter_id = request.args.get('limiter_id')
+    if limiter_id and not ObjectId.is_valid(limiter_id):
+        return jsonify({'error': 'Invalid limiter_id'}), 400
+    return jsonify(rate_limiter.get_top_rate_limit_counters(limit, limiter_id))
+
+@app.route('/api/top_traffic')
+def get_top_traffic():
+    status = check_server_ready()
+    if status:
+        return status
+    field = request.args.get('field', 'sender')
+    if field not in TRAFFIC_TOP_FIELDS:
+        return jsonify({'error': f"Unknown field. Must be one of {', '.join(TRAFFIC_TOP_FIELDS)}"}), 400
+    limit = min(request.args.get('limit', default=10, type=int), 50)
+    return jsonify(traffic_hitters.top(field, limit))
 
 @app.route('/health')
 def health_check():
-    return jsonify(status='healthy'), 200
+    if not server_ready:
+        return jsonify(status='starting', ready=False), 503
+    return jsonify(status='healthy', ready=True, startup=startup_status, datastore=storage.status()), 200
 
 @socketio.on('connect')
 def on_connect():
@@ -490,19 +523,24 @@ def on_leave(data):
     print(f'Client {request.sid} left room: {room}')
 
 def create_app():
+    # Recover requests spooled by a previous run and start replaying them
+    request_spool.start()
+
+    # Rules and rate limiters are loaded and compiled before the policy
+    # socket accepts its first connection
+    initialize_server()
+    start_rule_refresher()
+    rate_limiter.start()
+    start_snapshot_writer()
+
     # Start socket listener in a separate thread
     socket_thread = threading.Thread(target=socket_listener)
     socket_thread.start()
 
-    # Start MongoDB cleanup in a separate thread
+    # Start request history cleanup in a separate thread
     cleanup_thread = threading.Thread(target=periodic_mongodb_cleanup)
     cleanup_thread.start()
 
-    # Initialize the server
-    initialize_server()
-
-    ensure_rule_ids()
-
     return app
 
 app = create_app()
@@ -0,0 +1,137 @@
+import time
+import traceback
+from datetime import datetime, timezone
+
+from bson import ObjectId
+
+from rules import apply_rules, determine_final_action
+from ratelimiter import rate_limiter
+from config import REQUEST_BUDGET_MS, DEGRADED_ACTION, DEGRADED_TEXT
+from config import RECENT_REQUESTS_CAPACITY, RECENT_REQUESTS_MAX_AGE_SECONDS, THREAD_STRIPES
+from config import TRAFFIC_TOP_FIELDS, TRAFFIC_TOP_CAPACITY, TRAFFIC_TOP_WINDOW_SECONDS
+from utils import determine_version
+from record import parse_request
+from spool import request_spool
+from heavyhitters import TrafficHitters
+from striped import StripedRecentBuffer
+from changelog import change_log
+from storage import policy_request, StorageError
+
+# Shared state of the policy threads.  Appends to data_storage go to a
+# per-thread ring buffer and current_version is only ever rebound.  The
+# spool and the change log each take one lock per request, but only after
+# the answer has been sent.
+data_storage = StripedRecentBuffer(RECENT_REQUESTS_MAX_AGE_SECONDS, RECENT_REQUESTS_CAPACITY, THREAD_STRIPES)
+traffic_hitters = TrafficHitters(TRAFFIC_TOP_FIELDS, TRAFFIC_TOP_CAPACITY, TRAFFIC_TOP_WINDOW_SECONDS, THREAD_STRIPES)
+current_version = "Unknown"
+
+def degraded_action():
+    # None lets the request fall through to DUNNO (fail open)
+    if DEGRADED_ACTION == 'DEFER':
+        return f"DEFER {DEGRADED_TEXT}"
+    return None
+
+def decide(parsed_data):
+    """Apply the rules and, if none matched, the rate limiters; return the final action or None."""
+    parsed_data['timestamp'] = datetime.now(timezone.utc)
+    try:
+        rule_results = apply_rules(parsed_data)
+        # Determine the final action based on the first (and only) matching rule
+        final_action = determine_final_action(rule_results)
+    except StorageError as e:
+        # No rule set has been loaded yet and the datastore is unavailable
+        print(f"Rules unavailable: {str(e)}")
+        rule_results = []
+        final_action = degraded_action()
+    parsed_data['rule_results'] = rule_results
+
+    # If no rule was applied (final_action is None), check rate limit
+    if final_action is None:
+        try:
+            within_limit = rate_limiter.check_rate_limit(parsed_data)
+        except StorageError as e:
+            print(f"Rate limiter unavailable: {str(e)}")
+            final_action = degraded_action()
+            within_limit = True
+        if not within_limit:
+            custom_text = rate_limiter.get_custom_text(parsed_data)
+            if custom_text:
+                final_action = f"REJECT {custom_text}"
+            else:
+                final_action = "REJECT 400: Rate limit exceeded"
+            print("Rate limit exceeded")
+    return final_action
+
+def store_in_mongodb(parsed_data):
+    parsed_data['_id'] = ObjectId()
+    # Spool locally; the replay thread bulk-inserts into the datastore when it is reachable.
+    # The request is encoded right away, so the caller can keep using it as its payload.
+    request_spool.append(parsed_data)
+
+def handle_client(client_socket, address, publish):
+    """Answer policy requests on client_socket until it is closed.
+
+    publish is called with the new_data event of every request.
+    """
+    global current_version
+    print(f"Connection from {address} has been established.")
+    buffer = ""
+    while True:
+        try:
+            chunk = client_socket.recv(1024)
+            if not chunk:
+                print(f"Connection closed by client {address}")
+                break
+            buffer += chunk.decode('utf-8')
+            if buffer.endswith('\n\n'):
+                # Check if the request is valid
+                if "request=smtpd_access_policy" not in buffer:
+                    print("Invalid request: missing 'request=smtpd_access_policy'")
+                    response = "REJECT Invalid request\n\n"
+                    client_socket.sendall(response.encode('utf-8'))
+                    buffer = ""
+                    continue
+
+                instance_data = parse_request(buffer)
+
+                version = determine_version(instance_data)
+                current_version = version
+                traffic_hitters.observe(instance_data)
+
+                # Every datastore call below shares one deadline, so Postfix
+                # gets an answer within REQUEST_BUDGET_MS even if the datastore hangs
+                with policy_request(REQUEST_BUDGET_MS / 1000):
+                    final_action = decide(instance_data)
+
+                # Always update the final_action in instance_data
+                instance_data['final_action'] = final_action if final_action else "DUNNO"
+
+                # Extract custom text if present
+                custom_text = instance_data.get('custom_text', '')
+
+                # Send response back to the socket client before the spool, the
+                # change log and the event, which take locks shared by all connections
+                response = f"{instance_data['final_action']} {custom_text}\n\n".strip() + "\n\n"
+                client_socket.sendall(response.encode('utf-8'))
+
+                # The spooled request is the payload too; datetimes and
+                # ObjectIds are left to the encoder of each consumer
+                store_in_mongodb(instance_data)
+                request_id = str(instance_data['_id'])
+                data_storage.append(request_id, instance_data, time.time())
+                change_version = change_log.record('requests', 'insert', request_id, instance_data)
+
+                # Always publish the new_data event, regardless of the action
+                publish({
+                    'data': instance_data,
+                    'version': version,
+                    'action': instance_data['final_action'],
+                    'change_version': change_version
+                })
+
+                buffer = ""
+        except Exception as e:
+            print(f"Error processing data from {address}: {str(e)}")
+            print(traceback.format_exc())
+            break
+    client_socket.close()
@@ -9,6 +9,7 @@ import Brightness7Icon from '@material-ui/icons/Brightness7';
 import RecentRequests from './RecentRequests';
 import RulesList from './RulesList';
 import RateLimiterList from './RateLimiterList';
+import { applyChanges, createDeltaCursor } from '../deltaSync';
 
 const MAX_RETRIES = 5;
 const RETRY_DELAY = 2000;
@@ -29,6 +30,10 @@ axiosRetry(api, {
   },
 });
 
+// After the first full load only the changes since the last sync are fetched
+const requestsCursor = createDeltaCursor(api, 'requests');
+const rulesCursor = createDeltaCursor(api, 'rules');
+
 const socket = io('http://localhost:8000', {
   transports: ['websocket'],
   autoConnect: false
@@ -147,18 +152,39 @@ function Dashboard({ darkMode, setDarkMode }) {
     });
   }, [fetchDataWithRetry]);
 
-  const fetchAllData = useCallback(async () => {
-    setLoading(true);
+  const syncData = useCallback(() => {
+    return fetchDataWithRetry(async () => {
+      const changes = await requestsCursor.pull();
+      if (changes === null) {
+        await fetchData();
+      } else {
+        setHistoricalData(prevData => applyChanges(prevData, changes, { prepend: true }));
+      }
+    });
+  }, [fetchDataWithRetry, fetchData]);
+
+  const syncRules = useCallback(() => {
+    return fetchDataWithRetry(async () => {
+      const changes = await rulesCursor.pull();
+      if (changes === null) {
+        await fetchRules();
+      } else {
+        setRules(prevRules => applyChanges(prevRules, changes));
+      }
+    });
+  }, [fetchDataWithRetry, fetchRules]);
+
+  const syncAllData = useCallback(async () => {
     setError(null);
     try {
-      await Promise.all([fetchData(), fetchRules()]);
+      await Promise.all([syncData(), syncRules()]);
     } catch (error) {
       setError('Failed to fetch data. Please try again.');
       console.error('Error fetching data:', error);
     } finally {
       setLoading(false);
     }
-  }, [fetchData, fetchRules]);
+  }, [syncData, syncRules]);
 
   const initializeSocket = useCallback(() => {
     if (!socket.connected) {
@@ -173,7 +199,6 @@ function Dashboard({ darkMode, setDarkMode }) {
       setSocketConnected(true);
       socket.emit('join', { room: 'updates' });
       console.log('Joined updates room');
-      fetchAllData();
     }
 
     function onDisconnect(reason) {
@@ -184,7 +209,10 @@ function Dashboard({ darkMode, setDarkMode }) {
 
     function onNewData(newData) {
       console.log('New data received:', newData);
-      setHistoricalData(prevData => [newData.data, ...prevData]);
+      // The same request may already have arrived through a delta sync
+      setHistoricalData(prevData => applyChanges(
+        prevData, [{ op: 'insert', id: newData.data._id, item: newData.data }], { prepend: true }
+      ));
     }
 
     socket.on('connect', onConnect);
@@ -196,7 +224,7 @@ function Dashboard({ darkMode, setDarkMode }) {
       socket.off('disconnect', onDisconnect);
       socket.off('new_data', onNewData);
     };
-  }, [fetchAllData]);
+  }, []);
 
   useEffect(() => {
     checkServerStatus();
@@ -215,9 +243,9 @@ function Dashboard({ darkMode, setDarkMode }) {
 
   useEffect(() => {
     if (socketConnected) {
-      fetchAllData();
+      syncAllData();
     }
-  }, [socketConnected, fetchAllData]);
+  }, [socketConnected, syncAllData]);
 
   const handleTabChange = (event, newValue) => {
     setActiveTab(newValue);
@@ -264,9 +292,9 @@ function Dashboard({ darkMode, setDarkMode }) {
         </Paper>
         <Box className={classes.tabContent}>
           {activeTab === 0 ? (
-            <RecentRequests data={historicalData} />
+            <RecentRequests data={historicalData} rules={rules} />
           ) : activeTab === 1 ? (
-            <RulesList rules={rules} onRulesChange={fetchRules} />
+            <RulesList rules={rules} onRulesChange={syncRules} />
           ) : (
             <RateLimiterList />
           )}
@@ -1,9 +1,10 @@
-import React, { useState, useEffect, useCallback } from 'react';
+import React, { useState, useEffect, useCallback, useRef } from 'react';
 import axios from 'axios';
 import axiosRetry from 'axios-retry';
 import { Table, TableBody, TableCell, Divider, TableContainer, TableHead, makeStyles, TableRow, Grid, Paper, Button, TextField, Select, MenuItem, FormControl, InputLabel, Dialog, DialogTitle, DialogContent, DialogActions, IconButton, Typography, Box, TablePagination } from '@material-ui/core';
 import EditIcon from '@material-ui/icons/Edit';
 import DeleteIcon from '@material-ui/icons/Delete';
+import { applyChanges, createDeltaCursor } from '../deltaSync';
 
 const api = axios.create({
   baseURL: 'http://localhost:8000',
@@ -43,6 +44,7 @@ function RateLimiterList() {
   const [page, setPage] = useState(0);
   const [rowsPerPage, setRowsPerPage] = useState(10);
   const [connectionError, setConnectionError] = useState(null);
+  const rateLimitersCursor = useRef(createDeltaCursor(api, 'rate_limiters'));
 
   const fetchKeyOptions = useCallback(async () => {
     try {
@@ -57,7 +59,7 @@ function RateLimiterList() {
 
   useEffect(() => {
     fetchKeyOptions();
-    fetchRateLimiters();
+    syncRateLimiters();
     fetchTopRateLimitCounters();
     const interval = setInterval(fetchTopRateLimitCounters, 5000);
     return () => clearInterval(interval);
@@ -72,6 +74,19 @@ function RateLimiterList() {
     }
   };
 
+  const syncRateLimiters = async () => {
+    try {
+      const changes = await rateLimitersCursor.current.pull();
+      if (changes === null) {
+        await fetchRateLimiters();
+      } else {
+        setRateLimiters(prevLimiters => applyChanges(prevLimiters, changes));
+      }
+    } catch (error) {
+      console.error('Error syncing rate limiters:', error);
+    }
+  };
+
   const fetchTopRateLimitCounters = async () => {
     try {
       const limit = rowsPerPage * 5;
@@ -96,7 +111,7 @@ function RateLimiterList() {
   const handleCreateLimiter = async () => {
     try {
       await api.post('/api/rate_limiters', newLimiter);
-      fetchRateLimiters();
+      syncRateLimiters();
       handleClose();
     } catch (error) {
       console.error('Error creating rate limiter:', error);
@@ -121,7 +136,7 @@ function RateLimiterList() {
   const handleUpdateLimiter = async () => {
     try {
       await api.put(`/api/rate_limiters/${editingLimiter._id}`, editingLimiter);
-      fetchRateLimiters();
+      syncRateLimiters();
       handleEditClose();
     } catch (error) {
       console.error('Error updating rate limiter:', error);
@@ -131,7 +146,7 @@ function RateLimiterList() {
   const handleDeleteLimiter = async (id) => {
     try {
       await api.delete(`/api/rate_limiters/${id}`);
-      fetchRateLimiters();
+      syncRateLimiters();
     } catch (error) {
       console.error('Error deleting rate limiter:', error);
     }
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useMemo } from 'react';
 import axios from 'axios';
 import { 
   Table, Typography, TableBody, TableCell, TableContainer, TableHead, TableRow, 
@@ -22,7 +22,7 @@ const TablePaginationComponent = (props) => (
   <TablePagination component="div" {...props} />
 );
 
-function RecentRequests({ data }) {
+function RecentRequests({ data, rules }) {
   const classes = useStyles();
   const [activeColumns, setActiveColumns] = useState([
     'queue_id', 'sasl_username', 'sender', 'recipient', 'size', 'final_action', 'timestamp'
@@ -30,7 +30,14 @@ function RecentRequests({ data }) {
 
   const [columns, setColumns] = useState([]);
   const [isLoading, setIsLoading] = useState(true);
-  const [ruleInfo, setRuleInfo] = useState({});
+  // Rule names come from the rules the dashboard keeps in sync
+  const ruleInfo = useMemo(() => {
+    const ruleMap = {};
+    rules.forEach(rule => {
+      ruleMap[rule.rule_id] = rule.name;
+    });
+    return ruleMap;
+  }, [rules]);
 
   const [page, setPage] = useState(0);
   const [rowsPerPage, setRowsPerPage] = useState(25);
@@ -56,18 +63,6 @@ function RecentRequests({ data }) {
         console.error('Error fetching key options:', error);
         setIsLoading(false);
       });
-
-    axios.get('http://localhost:8000/api/rules')
-      .then(response => {
-        const ruleMap = {};
-        response.data.forEach(rule => {
-          ruleMap[rule.rule_id] = rule.name;
-        });
-        setRuleInfo(ruleMap);
-      })
-      .catch(error => {
-        console.error('Error fetching rules:', error);
-      });
   }, []);
 
   const toggleColumn = (columnId) => {
@@ -1,5 +1,6 @@
 import React, { useState, useEffect, useMemo } from 'react';
 import axios from 'axios';
+import { applyChanges } from '../deltaSync';
 import { Paper, Typography, Button, Dialog, DialogTitle, DialogContent, DialogActions, TextField, Table, TableBody, TableCell, TableContainer, TableHead, TableRow, TablePagination, Select, MenuItem, FormControl, InputLabel, Box, IconButton, Grid, makeStyles, Tooltip } from '@material-ui/core';
 import EditIcon from '@material-ui/icons/Edit';
 import DeleteIcon from '@material-ui/icons/Delete';
@@ -41,7 +42,7 @@ function RulesList({ rules: initialRules, onRulesChange }) {
 
   // Use useMemo to sort rules whenever they change
   const sortedRules = useMemo(() => {
-    return [...rules].sort((a, b) => a.rule_id - b.rule_id);
+    return [...rules].sort((a, b) => (a.position - b.position) || (a.rule_id - b.rule_id));
   }, [rules]);
 
   useEffect(() => {
@@ -136,19 +137,12 @@ function RulesList({ rules: initialRules, onRulesChange }) {
     try {
       const ruleToSubmit = { ...newRule };
       delete ruleToSubmit.custom_number; // Remove custom_number from the submitted data
-
-      // Find the highest existing rule_id
-      const highestId = Math.max(...sortedRules.map(rule => rule.rule_id), 0);
-      
-      // Assign the next available ID to the new rule
-      ruleToSubmit.rule_id = highestId + 1;
+      // rule_id and position are assigned by the server
 
       console.log('Submitting rule:', ruleToSubmit);
       await axios.post('http://localhost:8000/api/rules', ruleToSubmit);
       
-      // Update the local state with the new rule
-      setRules(prevRules => [...prevRules, ruleToSubmit]);
-      
+      // Pulls only the new rule instead of the whole list
       onRulesChange();
       handleClose();
       
@@ -299,21 +293,22 @@ function RulesList({ rules: initialRules, onRulesChange }) {
   const moveRule = async (ruleId, direction) => {
     try {
       const index = sortedRules.findIndex(rule => rule.rule_id === ruleId);
-      let newPosition;
+      let target;
 
       if (direction === 'up' && index > 0) {
-        newPosition = sortedRules[index - 1].rule_id;
+        target = { before: sortedRules[index - 1].rule_id };
       } else if (direction === 'down' && index < sortedRules.length - 1) {
-        newPosition = sortedRules[index + 1].rule_id;
+        target = { after: sortedRules[index + 1].rule_id };
       } else {
         return; // Can't move further in this direction
       }
 
-      await axios.put(`http://localhost:8000/api/rules/${ruleId}/move`, { new_position: newPosition });
-      // Fetch updated rules after moving
-      const response = await axios.get('http://localhost:8000/api/rules');
-      setRules(response.data);
-      onRulesChange(response.data);
+      const response = await axios.put(`http://localhost:8000/api/rules/${ruleId}/move`, target);
+      // Only the moved rule gets a new position
+      setRules(prevRules => applyChanges(prevRules, response.data.changes.map(rule => (
+        { op: 'update', id: String(rule._id), item: rule }
+      ))));
+      onRulesChange();
     } catch (error) {
       console.error('Error moving rule:', error);
     }
@@ -0,0 +1,43 @@
+// Client side of the /api/changes delta protocol
+
+export function applyChanges(items, changes, { idKey = '_id', prepend = false } = {}) {
+  if (!changes || changes.length === 0) return items;
+  // Last state per id in the batch, null once deleted
+  const latest = new Map();
+  changes.forEach(change => latest.set(change.id, change.op === 'delete' ? null : change.item));
+  const kept = [];
+  items.forEach(item => {
+    const id = String(item[idKey]);
+    if (!latest.has(id)) {
+      kept.push(item);
+      return;
+    }
+    const updated = latest.get(id);
+    latest.delete(id);
+    if (updated !== null) kept.push(updated);
+  });
+  const added = [...latest.values()].filter(item => item !== null);
+  return prepend ? [...added.reverse(), ...kept] : [...kept, ...added];
+}
+
+// Remembers the version of the last sync for one collection.  pull() returns
+// the changes since then, or null when the collection has to be refetched in
+// full (first sync, server restart or the changes are no longer kept).
+export function createDeltaCursor(api, collection) {
+  let epoch = null;
+  let version = null;
+  return {
+    async pull() {
+      const params = { collections: collection };
+      if (epoch !== null) {
+        params.since = version;
+        params.epoch = epoch;
+      }
+      const response = await api.get('/api/changes', { params });
+      epoch = response.data.epoch;
+      version = response.data.version;
+      if (response.data.reset.includes(collection)) return null;
+      return response.data.changes[collection];
+    },
+  };
+}
@@ -1,143 +1,473 @@
 from datetime import datetime, timedelta
 from bson import ObjectId
+from operator import itemgetter
+import heapq
 import re
-from config import rate_limiters_collection, rate_limit_counters_collection
-import uuid
+import socket
+import threading
+import time
+from config import TOP_COUNTERS_CAPACITY
+from config import APPROX_ERROR_RATE, APPROX_DELTA, APPROX_PROMOTE_RATIO, KEY_OPTIONS
+from config import COUNTER_STRIPES, COUNTER_FLUSH_INTERVAL_MS, COUNTER_MAX_KEYS, LIMITER_LOAD_RETRY_SECONDS
+from heavyhitters import TopCounters
+from countmin import WindowedCountMin
+from striped import StripedCounters
+from storage import storage, StorageError
+
+# Expired counters never match a window in check_rate_limit, so removing them
+# is housekeeping for the background writer
+COUNTER_CLEANUP_INTERVAL = timedelta(seconds=60)
+
+# Weighted limiters count the value of one of these request fields instead of 1
+WEIGHT_FIELDS = ('size', 'recipient_count')
+# Joins the parts of a compound key, e.g. "alice|example.com"
+COMPOUND_SEPARATOR = '|'
+
+def _lower(value):
+    return value.lower()
+
+def _domain(value):
+    return value.rpartition('@')[2].lower()
+
+def _cidr(ipv4_prefix, ipv6_prefix):
+    # inet_pton plus integer masking is several times faster than ipaddress
+    def mask(value):
+        family, prefix, bits = (socket.AF_INET6, ipv6_prefix, 128) if ':' in value else (socket.AF_INET, ipv4_prefix, 32)
+        try:
+            packed = socket.inet_pton(family, value)
+        except OSError:
+            return value
+        network = int.from_bytes(packed, 'big') >> (bits - prefix) << (bits - prefix)
+        return f"{socket.inet_ntop(family, network.to_bytes(len(packed), 'big'))}/{prefix}"
+    return mask
+
+def parse_key_spec(spec):
+    """Parse 'field' or 'field:transform' into (field, transform function or None).
+
+    Transforms are lower, domain (the part after the last @, lowercased) and
+    cidrN or cidrN/M (IPv4 addresses masked to /N, IPv6 to /M, default /64).
+    """
+    field, _, transform = spec.partition(':')
+    if field not in KEY_OPTIONS:
+        raise ValueError(f"Unknown key field {field!r}")
+    if not transform:
+        return field, None
+    if transform == 'lower':
+        return field, _lower
+    if transform == 'domain':
+        return field, _domain
+    match = re.fullmatch(r'cidr(\d+)(?:/(\d+))?', transform)
+    if match and int(match.group(1)) <= 32 and int(match.group(2) or 64) <= 128:
+        return field, _cidr(int(match.group(1)), int(match.group(2) or 64))
+    raise ValueError(f"Unknown key transform {transform!r}")
+
+def validate_limiter_keys(key, keys=None, weight=None):
+    """Raise ValueError unless the key specs and weight field are usable."""
+    if keys is not None and not isinstance(keys, list):
+        raise ValueError("keys must be a list")
+    for spec in keys or [key]:
+        if not isinstance(spec, str):
+            raise ValueError("Keys must be strings")
+        parse_key_spec(spec)
+    if weight and weight not in WEIGHT_FIELDS:
+        raise ValueError(f"weight must be one of {', '.join(WEIGHT_FIELDS)}")
+
+def compile_matcher(value, condition):
+    try:
+        if condition == 'exact':
+            return value.__eq__
+        if condition == 'regex':
+            return re.compile(value).match
+        if condition == 'wildcard':
+            pattern = re.escape(value).replace('\\*', '.*')
+            return re.compile(f'^{pattern}$').match
+    except re.error as e:
+        print(f"Invalid pattern {value!r} in rate limiter: {str(e)}")
+    return lambda data_value: False
+
+
+class CompiledLimiter:
+    """A limiter of the published snapshot, prepared for check_rate_limit."""
+
+    __slots__ = ('limiter', 'specs', 'key_name', 'match', 'weight', 'counters')
+
+    def __init__(self, limiter, counters):
+        self.limiter = limiter
+        keys = limiter.get('keys') or [limiter['key']]
+        # (spec, field, transform): derived values are cached per request by spec
+        self.specs = tuple((spec,) + parse_key_spec(spec) for spec in keys)
+        self.key_name = '+'.join(keys)
+        self.match = compile_matcher(limiter['value'], limiter['condition'])
+        self.weight = limiter.get('weight')
+        self.counters = counters
+
+    def derive(self, parsed_data, derived):
+        """The limiter's key for this request, or None if a field is missing."""
+        parts = []
+        for spec, field, transform in self.specs:
+            part = derived.get(spec)
+            if part is None:
+                value = parsed_data.get(field)
+                if value is None:
+                    return None
+                part = derived[spec] = transform(value) if transform else value
+            parts.append(part)
+        return parts[0] if len(parts) == 1 else COMPOUND_SEPARATOR.join(parts)
+
+    def weigh(self, parsed_data):
+        if self.weight is None:
+            return 1
+        try:
+            return max(int(parsed_data.get(self.weight)), 0)
+        except (TypeError, ValueError):
+            return None
+
 
 class RateLimiter:
+    """Rate limiting with a lock-free read path for its configuration.
+
+    `rate_limiters` is an immutable tuple that is only ever replaced as a whole
+    (copy-on-write under config_lock), so check_rate_limit works on one
+    consistent snapshot without locking.  Counters are exact and live in
+    memory in one StripedCounters per limiter, keyed by the limiter's derived
+    key string; a background thread adds the hits counted here to the
+    counters shared by all servers in the datastore and adopts their totals,
+    keeps the top-K heaps up to date and removes expired counters.  Nothing is
+    read from the datastore until load() is called; if that has not succeeded
+    by start(), it is retried in the background until it does.
+    """
+
     def __init__(self):
-        self.rate_limiters = self.load_rate_limiters()
+        self.config_lock = threading.Lock()
+        self.rate_limiters = ()
+        self.compiled_limiters = ()
+        # limiter _id -> StripedCounters, kept across limiter updates
+        self.limiter_counters = {}
+        # Changed counters that could not be added to the shared ones yet, by counter _id
+        self.unflushed = {}
+        # Heaviest counters overall and per limiter, keyed by (limiter_id, value)
+        self.top_counters = TopCounters(TOP_COUNTERS_CAPACITY)
+        self.limiter_top_counters = {}
+        # Approximate limiters: limiter _id -> ((duration, error_rate), WindowedCountMin)
+        self.sketches = {}
+        self.writer_thread = None
+        # True once limiters and counters have been read from the datastore
+        self.loaded = False
+
+    def load(self):
+        """Load the limiters and the counters of their current windows."""
+        storage.counters.ensure_indexes()
+        limiters = self.load_rate_limiters()
+        self.publish(lambda current: limiters)
+        self.load_counters()
+        self.loaded = True
 
     def load_rate_limiters(self):
-        return list(rate_limiters_collection.find())
+        return tuple(storage.rate_limiters.all())
+
+    def publish(self, change):
+        """Replace the limiter snapshot with change(current snapshot)."""
+        with self.config_lock:
+            limiters = tuple(change(self.rate_limiters))
+            compiled = []
+            for limiter in limiters:
+                counters = self.limiter_counters.get(limiter['_id'])
+                if counters is None:
+                    counters = self.limiter_counters[limiter['_id']] = StripedCounters(COUNTER_STRIPES, COUNTER_MAX_KEYS)
+                try:
+                    compiled.append(CompiledLimiter(limiter, counters))
+                except ValueError as e:
+                    print(f"Skipping rate limiter {limiter['_id']}: {str(e)}")
+            self.compiled_limiters = tuple(compiled)
+            self.rate_limiters = limiters
+            # Counters of deleted limiters go with them
+            present = {limiter['_id'] for limiter in limiters}
+            for limiter_id in [limiter_id for limiter_id in self.limiter_counters if limiter_id not in present]:
+                del self.limiter_counters[limiter_id]
+
+    def start(self):
+        if self.writer_thread is None:
+            self.writer_thread = threading.Thread(target=self._writer_loop, name='counter-writer', daemon=True)
+            self.writer_thread.start()
+            threading.Thread(target=self._load_loop, name='limiter-load', daemon=True).start()
+
+    def _load_loop(self):
+        while True:
+            time.sleep(LIMITER_LOAD_RETRY_SECONDS)
+            if self.loaded:
+                return
+            try:
+                self.load()
+                print(f"Loaded {len(self.rate_limiters)} rate limiters from the datastore")
+            except StorageError as e:
+                print(f"Could not load rate limiters, retrying in {LIMITER_LOAD_RETRY_SECONDS}s: {str(e)}")
 
     def check_rate_limit(self, parsed_data):
         now = datetime.utcnow()
-        self.clean_expired_counters(now)  # Clean expired counters
-        for limiter in self.rate_limiters:
-            key = limiter['key']
-            value = limiter['value']
-            condition = limiter['condition']
-            
-            if key not in parsed_data:
+        # Derived key parts (domain, CIDR, ...) shared by all limiters of this request
+        derived = {}
+        for compiled in self.compiled_limiters:
+            data_value = compiled.derive(parsed_data, derived)
+            if data_value is None or not compiled.match(data_value):
+                continue
+            weight = compiled.weigh(parsed_data)
+            if weight is None:
                 continue
-            
-            data_value = parsed_data[key]
-            
-            if self.match_condition(data_value, value, condition):
-                counter = rate_limit_counters_collection.find_one({
-                    'limiter_id': limiter['_id'],
-                    'key': key,
-                    'value': data_value,
-                    'timestamp': {'$gte': now - timedelta(minutes=limiter['duration'])}
-                })
-
-                if counter:
-                    if counter['count'] >= limiter['limit']:
-                        return False
-                    rate_limit_counters_collection.update_one(
-                        {'_id': counter['_id']},
-                        {'$inc': {'count': 1}}
-                    )
-                else:
-                    rate_limit_counters_collection.insert_one({
-                        'limiter_id': limiter['_id'],
-                        'key': key,
-                        'value': data_value,
-                        'count': 1,
-                        'timestamp': now
-                    })
+
+            limiter = compiled.limiter
+            estimate = None
+            if limiter.get('approximate'):
+                # Only keys whose estimate gets close to the limit get an exact counter
+                estimate = self.get_sketch(limiter).add(data_value, weight)
+                if estimate < limiter.get('promote_ratio', APPROX_PROMOTE_RATIO) * limiter['limit']:
+                    continue
+
+            allowed, _ = compiled.counters.increment(
+                data_value,
+                limiter['limit'],
+                now - timedelta(minutes=limiter['duration']),
+                {'limiter_id': limiter['_id'], 'key': compiled.key_name, 'value': data_value},
+                now,
+                weight,
+                estimate
+            )
+            if allowed is None:
+                # No room for another exact counter; count this key in the sketch
+                if estimate is None:
+                    estimate = self.get_sketch(limiter).add(data_value, weight)
+                allowed = estimate <= limiter['limit']
+            if not allowed:
+                return False
         return True
 
-    def match_condition(self, data_value, limiter_value, condition):
-        if condition == 'exact':
-            return data_value == limiter_value
-        elif condition == 'regex':
-            return re.match(limiter_value, data_value) is not None
-        elif condition == 'wildcard':
-            pattern = re.escape(limiter_value).replace('\\*', '.*')
-            return re.match(f'^{pattern}$', data_value) is not None
-        return False
-
-    def create_rate_limiter(self, key, value, condition, limit, duration, custom_text=''):
-        limiter_id = str(uuid.uuid4())
-        self.rate_limiters.append({
-            'id': limiter_id,
+    def get_sketch(self, limiter):
+        params = (limiter['duration'], limiter.get('error_rate') or APPROX_ERROR_RATE)
+        entry = self.sketches.get(limiter['_id'])
+        if entry is None or entry[0] != params:
+            new_entry = (params, WindowedCountMin(limiter['duration'] * 60, params[1], APPROX_DELTA))
+            if entry is None:
+                # setdefault so concurrent first hits share one sketch
+                entry = self.sketches.setdefault(limiter['_id'], new_entry)
+            else:
+                entry = self.sketches[limiter['_id']] = new_entry
+        return entry[1]
+
+    def restore_state(self, limiters, counters):
+        """Install limiters and counters saved by export_state()."""
+        self.publish(lambda current: tuple(limiters))
+        self.load_counters(counters)
+
+    def export_state(self):
+        """The current limiters and copies of all of their in-memory counters."""
+        limiters = self.rate_limiters
+        counters = [counter for limiter_counters in list(self.limiter_counters.values())
+                    for counter in limiter_counters.values()]
+        return list(limiters), counters
+
+    def load_counters(self, counters=None):
+        # Counters of the current windows, so limits survive a restart
+        now = datetime.utcnow()
+        limiters = self.rate_limiters
+        window_starts = {limiter['_id']: now - timedelta(minutes=limiter['duration']) for limiter in limiters}
+        current = {limiter_id: [] for limiter_id in window_starts}
+        for counter in counters if counters is not None else storage.counters.all():
+            window_start = window_starts.get(counter.get('limiter_id'))
+            if window_start is not None and counter['timestamp'] >= window_start:
+                current[counter['limiter_id']].append(counter)
+        for limiter in limiters:
+            limiter_counters = self.limiter_counters.get(limiter['_id'])
+            if limiter_counters is None:
+                continue  # deleted meanwhile
+            held = limiter_counters.load_many(current[limiter['_id']])
+            # Only counters that can make it into a top-K heap are offered to it
+            for counter in heapq.nlargest(TOP_COUNTERS_CAPACITY, held, key=itemgetter('count')):
+                self.record_counter(limiter, counter)
+
+    def _writer_loop(self):
+        last_cleanup = datetime.utcnow()
+        while True:
+            time.sleep(COUNTER_FLUSH_INTERVAL_MS / 1000)
+            try:
+                self.flush_counters()
+                now = datetime.utcnow()
+                if now - last_cleanup >= COUNTER_CLEANUP_INTERVAL:
+                    last_cleanup = now
+                    self.clean_expired_counters(now)
+            except StorageError as e:
+                print(f"Could not write rate limit counters: {str(e)}")
+            except Exception as e:
+                print(f"Error in rate limit counter writer: {str(e)}")
+
+    def flush_counters(self):
+        """Add the hits counted since the last flush to the shared counters and adopt their totals.
+
+        Hits on other servers only show up here after both have flushed, so
+        together servers can run past a limit by what they admit within one
+        COUNTER_FLUSH_INTERVAL_MS.
+        """
+        now = datetime.utcnow()
+        limiters = {limiter['_id']: limiter for limiter in self.rate_limiters}
+        for limiter_id, counters in list(self.limiter_counters.items()):
+            limiter = limiters.get(limiter_id)
+            for counter in counters.drain():
+                if limiter is not None:
+                    self.record_counter(limiter, counter)
+                    self.unflushed[counter['_id']] = counter
+        pending = [counter for counter in self.unflushed.values() if counter['limiter_id'] in limiters]
+        self.unflushed = {counter['_id']: counter for counter in pending}
+        if not pending:
+            return
+        storage.counters.add([
+            dict(counter, count=counter['count'] - counter['synced'],
+                 window_start=now - timedelta(minutes=limiters[counter['limiter_id']]['duration']))
+            for counter in pending
+        ])
+        # The hits are in the shared totals now; if reading them back fails,
+        # the retry must not add them a second time
+        for counter in pending:
+            counters = self.limiter_counters.get(counter['limiter_id'])
+            if counters is not None:
+                counters.acknowledge(counter)
+            counter['synced'] = counter['count']
+        totals = storage.counters.totals([(counter['limiter_id'], counter['value']) for counter in pending])
+        self.unflushed = {}
+        for counter in pending:
+            stored = totals.get((counter['limiter_id'], counter['value']))
+            counters = self.limiter_counters.get(counter['limiter_id'])
+            if stored is None or counters is None:
+                continue
+            synced = counters.sync(counter, stored)
+            if synced is not None:
+                self.record_counter(limiters[counter['limiter_id']], synced)
+
+    def record_counter(self, limiter, counter):
+        info = {
+            '_id': str(counter['_id']),
+            'key': counter['key'],
+            'value': counter['value'],
+            'timestamp': counter['timestamp']
+        }
+        entry_key = (limiter['_id'], counter['value'])
+        self.top_counters.update(entry_key, counter['count'], info)
+        limiter_top = self.limiter_top_counters.get(limiter['_id'])
+        if limiter_top is None:
+            limiter_top = self.limiter_top_counters.setdefault(limiter['_id'], TopCounters(TOP_COUNTERS_CAPACITY))
+        limiter_top.update(entry_key, counter['count'], info)
+
+    def create_rate_limiter(self, key, value, condition, limit, duration, custom_text='',
+                            approximate=False, error_rate=None, keys=None, weight=None):
+        limiter = {
             'key': key,
             'value': value,
             'condition': condition,
             'limit': limit,
             'duration': duration,
-            'customText': custom_text or ''  # Ensure customText is always a string
-        })
-        return limiter_id
+            'customText': custom_text or '',  # Ensure customText is always a string
+            'approximate': bool(approximate)
+        }
+        if error_rate:
+            limiter['error_rate'] = float(error_rate)
+        if keys:
+            limiter['keys'] = list(keys)
+        if weight:
+            limiter['weight'] = weight
+        # insert sets limiter['_id'], which check_rate_limit keys counters on
+        storage.rate_limiters.insert(limiter)
+        self.publish(lambda limiters: limiters + (limiter,))
+        return str(limiter['_id'])
 
-    def update_rate_limiter(self, limiter_id, value, condition, limit, duration, custom_text=''):
-        for limiter in self.rate_limiters:
-            if limiter['id'] == limiter_id:
-                limiter.update({
-                    'value': value,
-                    'condition': condition,
-                    'limit': limit,
-                    'duration': duration,
-                    'customText': custom_text or ''  # Ensure customText is always a string
-                })
-                break
+    def update_rate_limiter(self, limiter_id, value, condition, limit, duration, custom_text='',
+                            approximate=False, error_rate=None, keys=None, weight=None, key=None):
+        fields = {
+            'value': value,
+            'condition': condition,
+            'limit': limit,
+            'duration': duration,
+            'customText': custom_text or '',  # Ensure customText is always a string
+            'approximate': bool(approximate),
+            'error_rate': float(error_rate) if error_rate else None,
+            'keys': list(keys) if keys else None,
+            'weight': weight or None
+        }
+        # A compound limiter's key is always its joined keys
+        if keys:
+            fields['key'] = '+'.join(keys)
+        elif key:
+            fields['key'] = key
+        storage.rate_limiters.update(limiter_id, fields)
+        # Limiters in a published snapshot are never modified in place
+        self.publish(lambda limiters: tuple(
+            {**limiter, **fields} if str(limiter['_id']) == limiter_id else limiter
+            for limiter in limiters
+        ))
 
     def delete_rate_limiter(self, limiter_id):
-        rate_limiters_collection.delete_one({'_id': ObjectId(limiter_id)})
-        self.rate_limiters = [limiter for limiter in self.rate_limiters if str(limiter['_id']) != limiter_id]
+        storage.rate_limiters.delete(limiter_id)
+        self.publish(lambda limiters: tuple(limiter for limiter in limiters if str(limiter['_id']) != limiter_id))
+        self.limiter_top_counters.pop(ObjectId(limiter_id), None)
+        self.sketches.pop(ObjectId(limiter_id), None)
+        self.top_counters.discard_where(lambda entry_key, info: str(entry_key[0]) == limiter_id)
+
+    def get_rate_limiter(self, limiter_id):
+        for limiter in self.rate_limiters:
+            if str(limiter['_id']) == limiter_id:
+                return limiter
+        return None
 
     def get_rate_limiters(self):
-        return [{**limiter, '_id': str(limiter['_id'])} for limiter in self.rate_limiters]
-
-    def get_top_rate_limit_counters(self, limit=10):
-        pipeline = [
-            {"$sort": {"count": -1}},
-            {"$limit": limit},
-            {"$lookup": {
-                "from": "rate_limiters",
-                "localField": "limiter_id",
-                "foreignField": "_id",
-                "as": "limiter"
-            }},
-            {"$unwind": "$limiter"},
-            {"$project": {
-                "_id": {"$toString": "$_id"},
-                "key": 1,
-                "value": 1,
-                "count": 1,
-                "timestamp": 1,
-                "limiter_key": "$limiter.key",
-                "limiter_value": "$limiter.value",
-                "limiter_condition": "$limiter.condition",
-                "limiter_limit": "$limiter.limit",
-                "limiter_duration": "$limiter.duration"
-            }}
-        ]
-        return list(rate_limit_counters_collection.aggregate(pipeline))
+        # _id is converted by the JSON encoder
+        return list(self.rate_limiters)
 
-    def get_custom_text(self, parsed_data):
-        for limiter in self.rate_limiters:
-            key = limiter['key']
-            value = limiter['value']
-            condition = limiter['condition']
-            
-            if key not in parsed_data:
+    def get_top_rate_limit_counters(self, limit=10, limiter_id=None):
+        if limiter_id is None:
+            top_counters = self.top_counters
+        else:
+            top_counters = self.limiter_top_counters.get(ObjectId(limiter_id))
+            if top_counters is None:
+                return []
+
+        now = datetime.utcnow()
+        limiters = {limiter['_id']: limiter for limiter in self.rate_limiters}
+        result = []
+        # Over-fetch a little since expired windows and deleted limiters are skipped
+        for (counter_limiter_id, _), count, info in top_counters.top(limit * 2):
+            limiter = limiters.get(counter_limiter_id)
+            if limiter is None or info['timestamp'] < now - timedelta(minutes=limiter['duration']):
                 continue
-            
-            data_value = parsed_data[key]
+            result.append({
+                **info,
+                'count': count,
+                'limiter_key': limiter['key'],
+                'limiter_value': limiter['value'],
+                'limiter_condition': limiter['condition'],
+                'limiter_limit': limiter['limit'],
+                'limiter_duration': limiter['duration']
+            })
+            if len(result) >= limit:
+                break
+        return result
 
-            if self.match_condition(data_value, value, condition):
-                return limiter.get('customText', '')  # Return empty string if customText is not present
+    def get_custom_text(self, parsed_data):
+        derived = {}
+        for compiled in self.compiled_limiters:
+            data_value = compiled.derive(parsed_data, derived)
+            if data_value is not None and compiled.match(data_value):
+                return compiled.limiter.get('customText', '')  # Return empty string if customText is not present
         return ''
 
     def clean_expired_counters(self, now):
-        for limiter in self.rate_limiters:
+        limiters = {limiter['_id']: limiter for limiter in self.rate_limiters}
+        for limiter in limiters.values():
             expiration_time = now - timedelta(minutes=limiter['duration'])
-            rate_limit_counters_collection.delete_many({
-                'limiter_id': limiter['_id'],
-                'timestamp': {'$lt': expiration_time}
-            })
+            counters = self.limiter_counters.get(limiter['_id'])
+            if counters is not None:
+                counters.discard_where(lambda key, counter: counter['timestamp'] < expiration_time)
+            storage.counters.delete_expired(limiter['_id'], expiration_time)
+            self.top_counters.discard_where(
+                lambda entry_key, info: entry_key[0] == limiter['_id'] and info['timestamp'] < expiration_time
+            )
+            limiter_top = self.limiter_top_counters.get(limiter['_id'])
+            if limiter_top is not None:
+                limiter_top.discard_where(lambda entry_key, info: info['timestamp'] < expiration_time)
 
 rate_limiter = RateLimiter()
\ No newline at end of file
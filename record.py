@@ -0,0 +1,13 @@
+def parse_request(data):
+    """Parse a policy delegation request into the dict that is used for it throughout.
+
+    Rules and rate limiters read it, the verdict is written into it, and the
+    same dict is spooled and sent to API and socket clients, so a request is
+    never copied or converted on its way through the server.
+    """
+    request = {}
+    for line in data.strip().split('\n'):
+        key, separator, value = line.partition('=')
+        if separator:
+            request[key.strip()] = value.strip()
+    return request
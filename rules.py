@@ -1,15 +1,161 @@
-from datetime import datetime, timezone
-from config import requests_collection, rules_collection, VALID_ACTIONS, NN_REGEX
+from config import VALID_ACTIONS, NN_REGEX, RULES_REFRESH_SECONDS
+from storage import storage, remaining, StorageError
+from changelog import change_log
+from bisect import bisect_right
 import re
+import threading
+import time
+
+# Rules are evaluated in `position` order.  Positions are sparse floats, so a
+# rule is moved by giving it a key between its new neighbours and rule_id
+# stays a stable identity that is never renumbered.
+POSITION_STEP = 1024.0
+
+# Last successfully loaded rule set as (loaded_at, compiled rules).  It is
+# replaced as a whole, so readers never see a partially loaded list, and it is
+# what apply_rules keeps serving while the datastore is unavailable.
+_rules_snapshot = None
+# Serializes writers of the snapshot; apply_rules only ever reads it
+_snapshot_lock = threading.Lock()
+_snapshot_generation = 0
+# Only one policy thread loads the first rule set, the others wait for it
+_first_load_lock = threading.Lock()
+# Set to make the refresher reload right away instead of at the next interval
+_refresh_requested = threading.Event()
 
 def get_next_rule_id():
-    highest_rule = rules_collection.find_one(sort=[("rule_id", -1)])
-    if highest_rule:
-        return highest_rule["rule_id"] + 1
-    return 1
+    return storage.rules.next_rule_id()
+
+def get_next_position():
+    last_position = storage.rules.last_position()
+    if last_position is not None:
+        return last_position + POSITION_STEP
+    return POSITION_STEP
+
+def rule_sort_key(rule):
+    return (rule.get('position', 0.0), rule['rule_id'])
+
+def compile_condition(condition):
+    compiled = dict(condition)
+    try:
+        if condition['condition'] == 'regex':
+            compiled['pattern'] = re.compile(condition['value'])
+        elif condition['condition'] == 'wildcard':
+            compiled['pattern'] = re.compile(condition['value'].replace('*', '.*'))
+    except re.error as e:
+        print(f"Invalid pattern {condition['value']!r} in rule condition: {str(e)}")
+        compiled['pattern'] = None
+    return compiled
+
+def compile_rule(rule):
+    return {**rule, 'conditions': [compile_condition(cond) for cond in rule.get('conditions', [])]}
+
+def _without_patterns(rule):
+    return {**rule, 'conditions': [
+        {key: value for key, value in condition.items() if key != 'pattern'} for condition in rule['conditions']
+    ]}
+
+def load_rules(rules=None, record_changes=False):
+    """Compile and publish a rule set, by default the one in the datastore.
+
+    With record_changes, differences to the rule set it replaces are written
+    to the change log, for rules changed through other servers.
+    """
+    global _rules_snapshot
+    generation = _snapshot_generation
+    if rules is None:
+        rules = storage.rules.all()
+    rules = tuple(compile_rule(rule) for rule in rules)
+    with _snapshot_lock:
+        # A rule changed while loading; keep the patched snapshot and reload later
+        if generation == _snapshot_generation:
+            previous = _rules_snapshot
+            _rules_snapshot = (time.monotonic(), rules)
+            if record_changes and previous is not None:
+                _record_rule_changes(previous[1], rules)
+    return rules
+
+def _record_rule_changes(old_rules, new_rules):
+    old = {rule['_id']: _without_patterns(rule) for rule in old_rules}
+    for rule in new_rules:
+        plain = _without_patterns(rule)
+        previous = old.pop(rule['_id'], None)
+        if previous is None:
+            change_log.record('rules', 'insert', rule['_id'], plain)
+        elif previous != plain:
+            change_log.record('rules', 'update', rule['_id'], plain)
+    for rule_id in old:
+        change_log.record('rules', 'delete', rule_id)
+
+def loaded_rules():
+    """The current rule set without its compiled patterns, or None before the first load."""
+    snapshot = _rules_snapshot
+    if snapshot is None:
+        return None
+    return [_without_patterns(rule) for rule in snapshot[1]]
+
+def invalidate_rules():
+    global _snapshot_generation
+    with _snapshot_lock:
+        _snapshot_generation += 1
+    _refresh_requested.set()
+
+def swap_rule(rule_id, rule=None):
+    """Replace (or with rule=None remove) one rule in the compiled rule set.
+
+    The new rule set is built next to the current one and published with a
+    single assignment, so a change costs one compile instead of a reload.
+    """
+    global _rules_snapshot, _snapshot_generation
+    with _snapshot_lock:
+        _snapshot_generation += 1
+        snapshot = _rules_snapshot
+        if snapshot is None:
+            return
+        rules = [compiled for compiled in snapshot[1] if compiled['rule_id'] != rule_id]
+        if rule is not None:
+            compiled = compile_rule(rule)
+            # bisect only takes key= from Python 3.10 on, so search a list of keys
+            index = bisect_right([rule_sort_key(other) for other in rules], rule_sort_key(compiled))
+            rules.insert(index, compiled)
+        _rules_snapshot = (snapshot[0], tuple(rules))
+
+def _refresh_loop():
+    while True:
+        _refresh_requested.wait(RULES_REFRESH_SECONDS)
+        _refresh_requested.clear()
+        try:
+            load_rules(record_changes=True)
+        except StorageError as e:
+            print(f"Could not reload rules, using last known rule set: {str(e)}")
+
+def start_rule_refresher():
+    """Reload the rule set in the background every RULES_REFRESH_SECONDS.
+
+    Changes made through this server are applied immediately by swap_rule;
+    the refresh picks up changes made through other servers.
+    """
+    threading.Thread(target=_refresh_loop, name='rule-refresh', daemon=True).start()
+
+def get_compiled_rules():
+    snapshot = _rules_snapshot
+    if snapshot is not None:
+        return snapshot[1]
+    # Nothing loaded yet (the datastore was down at startup): load once,
+    # waiting no longer than the request's deadline for another thread's load
+    timeout = remaining()
+    if not _first_load_lock.acquire(timeout=-1 if timeout is None else timeout):
+        raise StorageError('Rules are still being loaded')
+    try:
+        snapshot = _rules_snapshot
+        if snapshot is not None:
+            return snapshot[1]
+        return load_rules()
+    finally:
+        _first_load_lock.release()
 
 def apply_rules(parsed_data):
-    rules = list(rules_collection.find().sort('rule_id', 1))
+    rules = get_compiled_rules()
     for rule in rules:
         result = apply_single_rule(rule, parsed_data)
         if result:
@@ -44,11 +190,14 @@ def evaluate_condition(condition, parsed_data):
     
     data_value = parsed_data[key]
     
-    if condition_type == 'regex':
-        return bool(re.match(value, data_value))
-    elif condition_type == 'exact':
+    if condition_type == 'exact':
         return data_value == value
-    elif condition_type == 'wildcard':
+    if condition_type in ('regex', 'wildcard'):
+        if 'pattern' in condition:
+            pattern = condition['pattern']
+            return pattern is not None and bool(pattern.match(data_value))
+        if condition_type == 'regex':
+            return bool(re.match(value, data_value))
         return bool(re.match(value.replace('*', '.*'), data_value))
     return False
 
@@ -76,23 +225,6 @@ def evaluate_complex_operator(results, operators):
     
     return current_result
 
-def store_in_mongodb(parsed_data):
-    parsed_data['timestamp'] = datetime.now(timezone.utc)
-    rule_results = apply_rules(parsed_data)
-    parsed_data['rule_results'] = rule_results
-    
-    # Determine the final action based on the first (and only) matching rule
-    final_action = determine_final_action(rule_results)
-    parsed_data['final_action'] = final_action
-    
-    result = requests_collection.insert_one(parsed_data)
-    parsed_data['_id'] = str(result.inserted_id)
-    
-    # bugfix json serializable error
-    parsed_data['timestamp'] = parsed_data['timestamp'].isoformat()
-
-    return final_action
-
 def determine_final_action(rule_results):
     if rule_results:
         result = rule_results[0]  # There will only be one result
@@ -100,64 +232,85 @@ def determine_final_action(rule_results):
     return None  # Return None if no rules match
 
 def create_new_rule(rule_data):
+    rule_data.pop('_id', None)
     rule_data['rule_id'] = get_next_rule_id()
-    rules_collection.insert_one(rule_data)
+    rule_data['position'] = get_next_position()
+    storage.rules.insert(rule_data)
+    swap_rule(rule_data['rule_id'], rule_data)
     return rule_data
 
-def update_rule_order(rule_id, new_position):
-    try:
-        rule = rules_collection.find_one({'rule_id': rule_id})
-        if not rule:
-            print(f"Rule with id {rule_id} not found")
-            return
+def _position_between(lower, upper):
+    if lower is None and upper is None:
+        return POSITION_STEP
+    if upper is None:
+        return lower + POSITION_STEP
+    if lower is None:
+        return upper - POSITION_STEP
+    position = (lower + upper) / 2
+    # Float precision is used up after ~50 moves into the same gap
+    if not lower < position < upper:
+        return None
+    return position
 
-        current_position = rule['rule_id']
-        if new_position == current_position:
-            print(f"Rule {rule_id} is already at position {new_position}")
-            return
+def _neighbour_positions(rule_id, before=None, after=None):
+    # Positions of the two rules the moved rule will end up between
+    if after is not None:
+        anchor = storage.rules.get(after)
+        if anchor is None:
+            return None
+        following = storage.rules.neighbour(anchor['position'], rule_id, following=True)
+        return anchor['position'], following['position'] if following else None
+    anchor = storage.rules.get(before)
+    if anchor is None:
+        return None
+    preceding = storage.rules.neighbour(anchor['position'], rule_id, following=False)
+    return preceding['position'] if preceding else None, anchor['position']
+
+def update_rule_order(rule_id, before=None, after=None):
+    """Move a rule directly before or after another rule.
+
+    Only the moved rule is written.  Returns the updated rule, or None if
+    either rule does not exist.
+    """
+    neighbours = _neighbour_positions(rule_id, before, after)
+    if neighbours is None:
+        return None
+    position = _position_between(*neighbours)
+    if position is None:
+        rebalance_positions()
+        neighbours = _neighbour_positions(rule_id, before, after)
+        position = _position_between(*neighbours)
+
+    rule = storage.rules.update(rule_id, {'position': position})
+    if rule is not None:
+        swap_rule(rule_id, rule)
+    return rule
 
-        if new_position < current_position:
-            # Moving up
-            print(f"Moving rule {rule_id} up from {current_position} to {new_position}")
-            rules_collection.update_many(
-                {'rule_id': {'$gte': new_position, '$lt': current_position}},
-                {'$inc': {'rule_id': 1}}
-            )
-        else:
-            # Moving down
-            print(f"Moving rule {rule_id} down from {current_position} to {new_position}")
-            rules_collection.update_many(
-                {'rule_id': {'$gt': current_position, '$lte': new_position}},
-                {'$inc': {'rule_id': -1}}
-            )
-
-        result = rules_collection.update_one({'_id': rule['_id']}, {'$set': {'rule_id': new_position}})
-        print(f"Update result: {result.modified_count} document(s) modified")
-    except Exception as e:
-        print(f"Error in update_rule_order: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        raise
+def rebalance_positions():
+    # Rare: respace every rule once the gap between two neighbours is exhausted
+    print("Rebalancing rule positions")
+    storage.rules.bulk_set([
+        (rule['_id'], {'position': index * POSITION_STEP})
+        for index, rule in enumerate(storage.rules.all(), start=1)
+    ])
+    invalidate_rules()
 
 def get_rules():
-    return list(rules_collection.find({}, {'_id': 0}).sort('rule_id', 1))
+    return storage.rules.all()
 
 def update_rule(rule_id, updated_data):
-    rules_collection.update_one({'rule_id': rule_id}, {'$set': updated_data})
+    """Update a rule's contents; identity and position are left alone."""
+    updated_data = {key: value for key, value in updated_data.items() if key not in ('_id', 'rule_id', 'position')}
+    rule = storage.rules.update(rule_id, updated_data)
+    if rule is not None:
+        swap_rule(rule_id, rule)
+    return rule
 
 def delete_rule(rule_id):
-    rule = rules_collection.find_one({'rule_id': rule_id})
-    if not rule:
-        return
-
-    # Delete the rule
-    rules_collection.delete_one({'rule_id': rule_id})
-
-    # Update the rule_id of all rules with higher rule_id
-    rules_collection.update_many(
-        {'rule_id': {'$gt': rule_id}},
-        {'$inc': {'rule_id': -1}}
-    )
+    rule = storage.rules.delete(rule_id)
+    if rule is not None:
+        swap_rule(rule_id)
+    return rule
 
 def validate_rule(rule):
     required_fields = ['name', 'conditions', 'operators', 'action_type', 'action']
@@ -202,9 +355,24 @@ def validate_rule(rule):
     
     return True
 
-# Function to ensure all rules have a rule_id
-def ensure_rule_ids():
-    rules = list(rules_collection.find(sort=[('rule_id', 1)]))
-    for i, rule in enumerate(rules, start=1):
-        if 'rule_id' not in rule or rule['rule_id'] != i:
-            rules_collection.update_one({'_id': rule['_id']}, {'$set': {'rule_id': i}})
\ No newline at end of file
+def ensure_rule_positions():
+    """Give rules from before sparse ordering a rule_id and a position.
+
+    Rules that already have a position are never touched, so after the first
+    start this is a single indexed query.
+    """
+    storage.rules.ensure_indexes()
+    legacy_rules = storage.rules.without_position()
+    if not legacy_rules:
+        return
+    next_rule_id = get_next_rule_id()
+    updates = []
+    for rule in legacy_rules:
+        if 'rule_id' not in rule:
+            rule['rule_id'] = next_rule_id
+            next_rule_id += 1
+        # Keeps the previous order, which was by rule_id
+        updates.append((rule['_id'], {'rule_id': rule['rule_id'], 'position': rule['rule_id'] * POSITION_STEP}))
+    storage.rules.bulk_set(updates)
+    print(f"Assigned positions to {len(updates)} rules")
+    invalidate_rules()
\ No newline at end of file
@@ -0,0 +1,92 @@
+import json
+from datetime import date, datetime
+
+import bson
+from bson import ObjectId
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from flask.json.provider import JSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional, the standard library encoder is used instead
+    orjson = None
+
+BSON_MIMETYPE = 'application/bson'
+
+# Codec options for queries whose results are passed through to the client as
+# raw BSON without being decoded into dicts first
+RAW_BSON_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+
+def _default(o):
+    if isinstance(o, datetime):
+        # MongoDB hands out naive datetimes that are in UTC
+        if o.tzinfo is None:
+            return o.isoformat() + '+00:00'
+        return o.isoformat()
+    if isinstance(o, ObjectId):
+        return str(o)
+    if isinstance(o, date):
+        return o.isoformat()
+    if isinstance(o, RawBSONDocument):
+        return dict(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_NAIVE_UTC
+
+    def dumps_bytes(obj, **kwargs):
+        """Encode obj as UTF-8 JSON; datetimes and ObjectIds need no preprocessing."""
+        try:
+            return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+        except TypeError:
+            # e.g. integers beyond 64 bit, which orjson refuses
+            return json.dumps(obj, default=_default).encode('utf-8')
+
+    def dumps(obj, **kwargs):
+        # str variant with the json.dumps signature, as expected by Flask-SocketIO
+        return dumps_bytes(obj).decode('utf-8')
+
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+else:
+    # One encoder for all calls; json.dumps with arguments builds a new one every time
+    _ENCODER = json.JSONEncoder(default=_default, separators=(',', ':'))
+
+    def dumps_bytes(obj, **kwargs):
+        """Encode obj as UTF-8 JSON; datetimes and ObjectIds need no preprocessing."""
+        return _ENCODER.encode(obj).encode('utf-8')
+
+    def dumps(obj, **kwargs):
+        return _ENCODER.encode(obj)
+
+    def loads(s, **kwargs):
+        return json.loads(s)
+
+
+def wants_bson(request):
+    """True if the client prefers raw BSON over JSON."""
+    return request.accept_mimetypes.best_match(['application/json', BSON_MIMETYPE]) == BSON_MIMETYPE
+
+
+def bson_bytes(payload):
+    # RawBSONDocument values are copied into the output as they are
+    return bson.encode(payload)
+
+
+class FastJSONProvider(JSONProvider):
+    """Flask JSON provider so jsonify() shares the encoder used everywhere else."""
+
+    mimetype = 'application/json'
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj)
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_bytes(obj), mimetype=self.mimetype)
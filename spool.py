@@ -0,0 +1,288 @@
+import os
+import struct
+import threading
+import time
+import traceback
+import zlib
+
+import bson
+from bson import ObjectId
+
+from config import SPOOL_DIR, SPOOL_SEGMENT_BYTES, SPOOL_MAX_BYTES, SPOOL_FSYNC_INTERVAL_MS
+from config import SPOOL_FSYNC_BATCH, SPOOL_REPLAY_INTERVAL, SPOOL_REPLAY_BATCH
+from storage import storage, StorageError
+
+# Segment layout: MAGIC followed by records of
+#   <u32 payload length> <u32 crc32 of payload> <BSON document>
+# A record is only considered written once its full payload and matching
+# checksum are on disk; anything after the last valid record is a torn write
+# and is truncated during recovery.
+MAGIC = b'PFXSPL1\n'
+RECORD_HEADER = struct.Struct('<II')
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.log'
+
+
+def _segment_name(sequence):
+    return f"{SEGMENT_PREFIX}{sequence:010d}{SEGMENT_SUFFIX}"
+
+
+def _segment_sequence(name):
+    return int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+
+def read_segment(path):
+    """Return (documents, valid_length) for a segment file."""
+    documents = []
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return documents, 0
+        valid_length = len(MAGIC)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            length, checksum = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                break
+            documents.append(bson.decode(payload))
+            valid_length += RECORD_HEADER.size + length
+    return documents, valid_length
+
+
+class Spool:
+    """Append-only, segmented local log of request documents.
+
+    The policy path only appends to the active segment; a background thread
+    batches fsyncs and another one replays sealed segments into the datastore with
+    insert_many.  Every document gets its ObjectId when it is spooled, so
+    replaying a segment twice after a crash cannot create duplicates.
+    """
+
+    def __init__(self, directory=SPOOL_DIR, segment_bytes=SPOOL_SEGMENT_BYTES, max_bytes=SPOOL_MAX_BYTES,
+                 fsync_interval_ms=SPOOL_FSYNC_INTERVAL_MS, fsync_batch=SPOOL_FSYNC_BATCH):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval_ms / 1000.0
+        self.fsync_batch = fsync_batch
+
+        self.lock = threading.Lock()
+        self.fsync_needed = threading.Event()
+        self.active = None
+        self.active_sequence = 0
+        self.active_size = 0
+        self.active_records = 0
+        self.unsynced = 0
+        self.sealed = []  # [(sequence, size, records)] oldest first
+        self.closing = []  # sealed segment files the fsync thread still has to sync and close
+        self.dropped_records = 0
+        self.started = False
+
+    # -- lifecycle -----------------------------------------------------
+
+    def recover(self):
+        """Validate segments left by a previous run and open a new active one."""
+        os.makedirs(self.directory, exist_ok=True)
+        sealed = []
+        for name in sorted(os.listdir(self.directory)):
+            if not (name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)):
+                continue
+            path = os.path.join(self.directory, name)
+            documents, valid_length = read_segment(path)
+            if not documents:
+                os.unlink(path)
+                continue
+            if valid_length < os.path.getsize(path):
+                print(f"Spool: truncating torn write in {name} at byte {valid_length}")
+                with open(path, 'r+b') as f:
+                    f.truncate(valid_length)
+            sealed.append((_segment_sequence(name), valid_length, len(documents)))
+            print(f"Spool: recovered {len(documents)} pending requests from {name}")
+
+        with self.lock:
+            self.sealed = sealed
+            self.active_sequence = sealed[-1][0] if sealed else 0
+            self._open_segment()
+
+    def start(self, replay=True):
+        if self.started:
+            return
+        self.recover()
+        self.started = True
+        threading.Thread(target=self._fsync_loop, daemon=True).start()
+        if replay:
+            threading.Thread(target=self._replay_loop, daemon=True).start()
+
+    def _open_segment(self):
+        # Nothing changes unless the new segment could be written
+        sequence = self.active_sequence + 1
+        active = open(os.path.join(self.directory, _segment_name(sequence)), 'wb')
+        try:
+            active.write(MAGIC)
+            active.flush()
+        except OSError:
+            active.close()
+            raise
+        self.active = active
+        self.active_sequence = sequence
+        self.active_size = len(MAGIC)
+        self.active_records = 0
+
+    def _seal_active(self):
+        """Start a new active segment.  Caller holds the lock.
+
+        The old segment is flushed here but synced and closed by the fsync
+        thread, so nobody waits for the disk while holding the lock.
+        """
+        sealed = (self.active_sequence, self.active_size, self.active_records)
+        self.active.flush()
+        closing = self.active
+        self._open_segment()
+        self.closing.append(closing)
+        self.unsynced = 0
+        self.sealed.append(sealed)
+        self.fsync_needed.set()
+
+    # -- write path ----------------------------------------------------
+
+    def append(self, document):
+        """Spool a request document and return its ObjectId.
+
+        A document that cannot be written (e.g. the disk is full) is counted
+        in dropped_records instead of failing the request.
+        """
+        if document.get('_id') is None:
+            document['_id'] = ObjectId()
+        payload = bson.encode(document)
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+        with self.lock:
+            try:
+                if self.active.closed:
+                    self._reopen_active()
+                if self.active_size > len(MAGIC) and self.active_size + len(record) > self.segment_bytes:
+                    self._seal_active()
+                self._enforce_limit(len(record))
+                self.active.write(record)
+                self.active.flush()
+            except OSError as e:
+                self.dropped_records += 1
+                print(f"Spool: could not write request {document['_id']}, dropped it: {str(e)}")
+                self._discard_failed_write()
+                return document['_id']
+            self.active_size += len(record)
+            self.active_records += 1
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_batch:
+                self.fsync_needed.set()
+        return document['_id']
+
+    def _discard_failed_write(self):
+        """Cut a partly written record off the active segment.  Caller holds the lock.
+
+        Recovery stops at the first torn record, so one left in place would
+        hide every record appended after it.
+        """
+        try:
+            # Closing drops whatever the failed flush left in the buffer
+            self.active.close()
+        except OSError:
+            pass
+        try:
+            self._reopen_active()
+        except OSError as e:
+            # Retried by the next append
+            print(f"Spool: could not reopen {_segment_name(self.active_sequence)}: {str(e)}")
+
+    def _reopen_active(self):
+        path = os.path.join(self.directory, _segment_name(self.active_sequence))
+        with open(path, 'r+b') as f:
+            f.truncate(self.active_size)
+        self.active = open(path, 'ab')
+
+    def _enforce_limit(self, incoming):
+        """Drop the oldest sealed segments when the spool would exceed max_bytes."""
+        while self.sealed and self.size() + incoming > self.max_bytes:
+            sequence, _, records = self.sealed.pop(0)
+            self.dropped_records += records
+            os.unlink(os.path.join(self.directory, _segment_name(sequence)))
+            print(f"Spool: size limit of {self.max_bytes} bytes reached, "
+                  f"dropped {records} requests from {_segment_name(sequence)}")
+
+    def size(self):
+        return self.active_size + sum(size for _, size, _ in self.sealed)
+
+    def _fsync_loop(self):
+        while True:
+            self.fsync_needed.wait(self.fsync_interval)
+            self.fsync_needed.clear()
+            try:
+                self.sync()
+            except OSError as e:
+                print(f"Spool: fsync failed: {str(e)}")
+
+    def sync(self):
+        with self.lock:
+            closing, self.closing = self.closing, []
+            fd = os.dup(self.active.fileno()) if self.unsynced and not self.active.closed else None
+            self.unsynced = 0
+        # fsync outside the lock so appends are never stuck behind the disk
+        for segment in closing:
+            os.fsync(segment.fileno())
+            segment.close()
+        if fd is not None:
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    # -- replay --------------------------------------------------------
+
+    def pending(self):
+        with self.lock:
+            return len(self.sealed) + (1 if self.active_size > len(MAGIC) else 0)
+
+    def replay(self, store=None, batch_size=SPOOL_REPLAY_BATCH):
+        """Insert every spooled document into the datastore; return the number replayed."""
+        store = store if store is not None else storage.requests
+        with self.lock:
+            if self.active_size > len(MAGIC):
+                self._seal_active()
+            segments = list(self.sealed)
+
+        self.sync()
+
+        replayed = 0
+        for sequence, _, _ in segments:
+            path = os.path.join(self.directory, _segment_name(sequence))
+            if not os.path.exists(path):
+                continue  # dropped by the size limit in the meantime
+            documents, _ = read_segment(path)
+            for start in range(0, len(documents), batch_size):
+                store.insert_many(documents[start:start + batch_size])
+            replayed += len(documents)
+            with self.lock:
+                self.sealed = [entry for entry in self.sealed if entry[0] != sequence]
+                if os.path.exists(path):
+                    os.unlink(path)
+        return replayed
+
+    def _replay_loop(self):
+        delay = SPOOL_REPLAY_INTERVAL
+        while True:
+            time.sleep(delay)
+            try:
+                self.replay()
+                delay = SPOOL_REPLAY_INTERVAL
+            except StorageError as e:
+                # The datastore is unreachable; keep spooling and back off
+                delay = min(delay * 2, 60)
+                print(f"Spool: replay failed, {self.pending()} segment(s) pending, retrying in {delay}s: {str(e)}")
+            except Exception as e:
+                print(f"Spool: unexpected replay error: {str(e)}")
+                print(traceback.format_exc())
+
+
+request_spool = Spool()
@@ -0,0 +1,136 @@
+import atexit
+import os
+import threading
+import time
+
+import bson
+from bson import ObjectId
+from bson.errors import InvalidBSON
+
+from config import WARM_SNAPSHOT_ENABLED, WARM_SNAPSHOT_PATH, WARM_SNAPSHOT_INTERVAL_SECONDS
+from config import WARM_SNAPSHOT_MAX_AGE_SECONDS, STARTUP_DATASTORE_TIMEOUT_MS
+from rules import ensure_rule_positions, load_rules, loaded_rules
+from ratelimiter import rate_limiter
+from storage import deadline, StorageError
+
+
+def load_from_datastore():
+    # One deadline for all of it, including the index builds in ensure_rule_positions
+    with deadline(STARTUP_DATASTORE_TIMEOUT_MS / 1000):
+        ensure_rule_positions()
+        load_rules()
+        rate_limiter.load()
+
+
+def _counter_columns(counters):
+    # Counters are stored column-wise per limiter, which decodes about twice as
+    # fast as one small document per counter
+    by_limiter = {}
+    for counter in counters:
+        by_limiter.setdefault(counter['limiter_id'], []).append(counter)
+    return [
+        {'limiter_id': limiter_id,
+         'ids': b''.join(counter['_id'].binary for counter in limiter_counters),
+         **{f'{field}s': [counter[field] for counter in limiter_counters]
+            for field in ('key', 'value', 'timestamp', 'count')}}
+        for limiter_id, limiter_counters in by_limiter.items()
+    ]
+
+
+def _counters_from_columns(columns):
+    counters = []
+    for group in columns:
+        limiter_id, ids = group['limiter_id'], group['ids']
+        counters.extend(
+            {'_id': ObjectId(ids[offset:offset + 12]), 'limiter_id': limiter_id, 'key': key, 'value': value,
+             'timestamp': timestamp, 'count': count}
+            for offset, key, value, timestamp, count in zip(
+                range(0, len(ids), 12), group['keys'], group['values'], group['timestamps'], group['counts'])
+        )
+    return counters
+
+
+def save_snapshot(path=WARM_SNAPSHOT_PATH):
+    """Write the loaded rules, rate limiters and counters to path.
+
+    Nothing is written before a rule set has been loaded, so a server that
+    never reached its datastore does not replace a good snapshot.
+    """
+    rules = loaded_rules()
+    if rules is None:
+        return False
+    limiters, counters = rate_limiter.export_state()
+    data = bson.encode({'saved_at': time.time(), 'rules': rules, 'rate_limiters': limiters,
+                        'counters': _counter_columns(counters)})
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+    return True
+
+
+def load_snapshot(path=WARM_SNAPSHOT_PATH, max_age=WARM_SNAPSHOT_MAX_AGE_SECONDS):
+    """Install the state saved by save_snapshot; False if there is no recent one."""
+    try:
+        with open(path, 'rb') as f:
+            snapshot = bson.decode(f.read())
+    except FileNotFoundError:
+        return False
+    except (OSError, InvalidBSON) as e:
+        print(f"Ignoring unreadable warm snapshot {path}: {str(e)}")
+        return False
+    age = time.time() - snapshot['saved_at']
+    if age > max_age:
+        print(f"Ignoring warm snapshot {path}, it is {age:.0f}s old")
+        return False
+    counters = _counters_from_columns(snapshot['counters'])
+    load_rules(snapshot['rules'])
+    rate_limiter.restore_state(snapshot['rate_limiters'], counters)
+    print(f"Loaded warm snapshot: {len(snapshot['rules'])} rules, {len(snapshot['rate_limiters'])} rate limiters, "
+          f"{len(counters)} counters")
+    return True
+
+
+def _refresh_from_datastore():
+    try:
+        load_from_datastore()
+    except StorageError as e:
+        # The snapshot stays in use; rules and rate limiters are retried in the background
+        print(f"Could not refresh warm snapshot from the datastore: {str(e)}")
+
+
+def warm_up(use_snapshot=WARM_SNAPSHOT_ENABLED):
+    """Load what the policy path needs before the first connection is accepted.
+
+    A recent warm snapshot makes the server ready without waiting for the
+    datastore, which is then read in the background.  Otherwise rules and
+    rate limiters are loaded from the datastore first.  Returns where the
+    state came from: 'snapshot', 'datastore' or None if neither was available.
+    """
+    if use_snapshot and load_snapshot():
+        threading.Thread(target=_refresh_from_datastore, name='warm-refresh', daemon=True).start()
+        return 'snapshot'
+    try:
+        load_from_datastore()
+        return 'datastore'
+    except StorageError as e:
+        print(f"Datastore unavailable at startup, rules and rate limiters will be loaded in the background: {str(e)}")
+        return None
+
+
+def _snapshot_loop():
+    while True:
+        time.sleep(WARM_SNAPSHOT_INTERVAL_SECONDS)
+        try:
+            save_snapshot()
+        except Exception as e:
+            print(f"Could not write warm snapshot: {str(e)}")
+
+
+def start_snapshot_writer():
+    if not WARM_SNAPSHOT_ENABLED:
+        return
+    threading.Thread(target=_snapshot_loop, name='warm-snapshot', daemon=True).start()
+    atexit.register(save_snapshot)
@@ -0,0 +1,110 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from config import STORAGE_BACKEND, SQLITE_PATH
+
+
+class StorageError(Exception):
+    """Any datastore failure; backends translate their own errors into it."""
+
+
+class DeadlineExceeded(StorageError):
+    """The enclosing deadline() ran out before or during a datastore call."""
+
+
+_deadline = threading.local()
+
+
+@contextmanager
+def deadline(seconds):
+    """Bound all datastore calls made inside the block to `seconds` in total.
+
+    Deadlines nest: an inner one can only shorten an enclosing one.
+    """
+    previous = getattr(_deadline, 'at', None)
+    at = time.monotonic() + seconds
+    _deadline.at = at if previous is None else min(at, previous)
+    try:
+        yield
+    finally:
+        _deadline.at = previous
+
+
+@contextmanager
+def policy_request(seconds):
+    """deadline() for answering a policy request.
+
+    Datastore calls inside it go through the backend's policy breaker and
+    deadlines; calls from anywhere else (the admin API and background
+    threads) use a separate breaker and deadlines.
+    """
+    previous = getattr(_deadline, 'policy', False)
+    _deadline.policy = True
+    try:
+        with deadline(seconds):
+            yield
+    finally:
+        _deadline.policy = previous
+
+
+def on_policy_path():
+    return getattr(_deadline, 'policy', False)
+
+
+def remaining(timeout=None):
+    """Seconds one datastore call may take: timeout capped by the enclosing deadline.
+
+    Returns timeout unchanged outside of deadline() and raises
+    DeadlineExceeded once the deadline has passed.
+    """
+    at = getattr(_deadline, 'at', None)
+    if at is None:
+        return timeout
+    left = at - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded('Datastore deadline exceeded')
+    return left if timeout is None else min(timeout, left)
+
+
+def create_backend(name):
+    if name == 'mongo':
+        from storage_mongo import MongoStorage
+        return MongoStorage()
+    if name == 'sqlite':
+        from storage_sqlite import SQLiteStorage
+        return SQLiteStorage(SQLITE_PATH)
+    raise ValueError(f"Unknown STORAGE_BACKEND {name!r}, expected 'mongo' or 'sqlite'")
+
+
+class Storage:
+    """The configured backend, created on first use.
+
+    Importing a module that stores data never opens a connection; the
+    backend is built the first time one of its stores is used.  A backend
+    provides `rules`, `rate_limiters`, `counters` and `requests` stores and
+    a status() for the health endpoint.
+    """
+
+    def __init__(self, backend_name):
+        self.backend_name = backend_name
+        self._backend = None
+        self._lock = threading.Lock()
+
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = create_backend(self.backend_name)
+        return self._backend
+
+    def use(self, backend):
+        """Replace the configured backend, e.g. with a temporary one in benchmarks."""
+        with self._lock:
+            self._backend = backend
+
+    def __getattr__(self, name):
+        return getattr(self.backend(), name)
+
+
+storage = Storage(STORAGE_BACKEND)
@@ -0,0 +1,344 @@
+import time
+
+import bson
+import pymongo
+from bson import ObjectId
+from pymongo import DeleteMany, MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from breaker import CircuitBreaker
+from config import MONGO_URI, MONGO_DATABASE, MONGO_CONNECT_TIMEOUT_MS, MONGO_SERVER_SELECTION_TIMEOUT_MS
+from config import MONGO_WRITE_TIMEOUT_MS, OPERATION_TIMEOUTS, BACKGROUND_OPERATION_TIMEOUTS
+from config import BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT
+from serialization import RAW_BSON_OPTIONS
+from storage import StorageError, on_policy_path, remaining
+
+DUPLICATE_KEY_ERROR = 11000
+RULE_ORDER = [('position', 1), ('rule_id', 1)]
+
+
+def _run(operation, args, kwargs, timeout):
+    # pymongo.timeout(None) leaves the client defaults in place
+    try:
+        with pymongo.timeout(timeout):
+            return operation(*args, **kwargs)
+    except PyMongoError as e:
+        raise StorageError(str(e)) from e
+
+
+def _insert_new(collection, documents):
+    # Documents that made it in before a crash are already there; only other
+    # write errors fail the call (and count against the breaker)
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        errors = [error for error in e.details.get('writeErrors', []) if error.get('code') != DUPLICATE_KEY_ERROR]
+        if errors or e.details.get('writeConcernErrors'):
+            raise
+
+
+class GuardedCursor:
+    """Cursor that fetches whole batches through the breaker.
+
+    It wraps a raw batch cursor, so the breaker and deadline are paid once
+    per batch (the first query and every getMore) instead of per document.
+    timeout bounds the time spent fetching all of the cursor's batches
+    together, or with per_batch each batch on its own, so long background
+    scans are not cut off half way.
+    """
+
+    def __init__(self, cursor, codec_options, breaker, timeout, per_batch=False):
+        self._cursor = cursor
+        self._codec_options = codec_options
+        self._breaker = breaker
+        self._timeout = timeout
+        self._per_batch = per_batch
+
+    def sort(self, *args, **kwargs):
+        self._cursor.sort(*args, **kwargs)
+        return self
+
+    def skip(self, *args, **kwargs):
+        self._cursor.skip(*args, **kwargs)
+        return self
+
+    def limit(self, *args, **kwargs):
+        self._cursor.limit(*args, **kwargs)
+        return self
+
+    def batch_size(self, *args, **kwargs):
+        self._cursor.batch_size(*args, **kwargs)
+        return self
+
+    def __iter__(self):
+        budget = self._timeout
+        while True:
+            started = time.monotonic()
+            # A spent budget only fails the next fetch that needs the server
+            timeout = remaining(None if budget is None else max(budget, 0))
+            try:
+                batch = self._breaker.call(_run, next, (self._cursor,), {}, timeout)
+            except StopIteration:
+                return
+            if budget is not None and not self._per_batch:
+                budget -= time.monotonic() - started
+            yield from bson.decode_all(batch, self._codec_options)
+
+
+class GuardedCollection:
+    """Collection proxy that runs every operation through a breaker with a deadline.
+
+    guards maps True (inside storage.policy_request()) and False (everything
+    else) to a (breaker, timeouts) pair; timeouts maps method names to
+    seconds.  Every deadline is capped by an enclosing storage.deadline() and
+    PyMongoErrors are raised as StorageError.
+    """
+
+    def __init__(self, collection, guards, default_timeout):
+        self._collection = collection
+        self._guards = guards
+        self._default_timeout = default_timeout
+
+    def _guard(self, method):
+        breaker, timeouts = self._guards[on_policy_path()]
+        return breaker, timeouts.get(method, self._default_timeout)
+
+    def _cursor(self, cursor, breaker, timeout):
+        # Policy requests bound a whole cursor, background scans each batch
+        return GuardedCursor(cursor, self._collection.codec_options, breaker, timeout, not on_policy_path())
+
+    def call(self, method, function, *args):
+        """Run function(collection, *args) as one guarded operation with the deadline of method."""
+        breaker, timeout = self._guard(method)
+        return breaker.call(_run, function, (self._collection,) + args, {}, remaining(timeout))
+
+    def with_options(self, **kwargs):
+        return GuardedCollection(self._collection.with_options(**kwargs), self._guards, self._default_timeout)
+
+    def find(self, *args, **kwargs):
+        breaker, timeout = self._guard('find')
+        return self._cursor(self._collection.find_raw_batches(*args, **kwargs), breaker, timeout)
+
+    def aggregate(self, *args, **kwargs):
+        breaker, timeout = self._guard('aggregate')
+        started = time.monotonic()
+        cursor = breaker.call(_run, self._collection.aggregate_raw_batches, args, kwargs, remaining(timeout))
+        if timeout is not None and on_policy_path():
+            timeout -= time.monotonic() - started
+        return self._cursor(cursor, breaker, timeout)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if not callable(attribute):
+            return attribute
+
+        def guarded(*args, **kwargs):
+            breaker, timeout = self._guard(name)
+            return breaker.call(_run, attribute, args, kwargs, remaining(timeout))
+        return guarded
+
+
+class MongoRuleStore:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def all(self):
+        return list(self.collection.find().sort(RULE_ORDER))
+
+    def get(self, rule_id):
+        return self.collection.find_one({'rule_id': rule_id})
+
+    def get_by_id(self, object_id):
+        return self.collection.find_one({'_id': ObjectId(object_id)})
+
+    def next_rule_id(self):
+        highest_rule = self.collection.find_one(sort=[('rule_id', -1)])
+        return highest_rule['rule_id'] + 1 if highest_rule else 1
+
+    def last_position(self):
+        last_rule = self.collection.find_one({'position': {'$exists': True}}, sort=[('position', -1)])
+        return last_rule['position'] if last_rule else None
+
+    def neighbour(self, position, rule_id, following):
+        """The closest rule after (or before) position, ignoring rule_id."""
+        if following:
+            return self.collection.find_one(
+                {'position': {'$gt': position}, 'rule_id': {'$ne': rule_id}}, sort=[('position', 1)]
+            )
+        return self.collection.find_one(
+            {'position': {'$lt': position}, 'rule_id': {'$ne': rule_id}}, sort=[('position', -1)]
+        )
+
+    def insert(self, rule):
+        # insert_one sets rule['_id']
+        self.collection.insert_one(rule)
+
+    def update(self, rule_id, fields):
+        return self.collection.find_one_and_update(
+            {'rule_id': rule_id}, {'$set': fields}, return_document=ReturnDocument.AFTER
+        )
+
+    def delete(self, rule_id):
+        return self.collection.find_one_and_delete({'rule_id': rule_id})
+
+    def bulk_set(self, updates):
+        """Apply [(_id, fields), ...] in one round trip."""
+        if updates:
+            self.collection.bulk_write(
+                [UpdateOne({'_id': object_id}, {'$set': fields}) for object_id, fields in updates], ordered=False
+            )
+
+    def without_position(self):
+        return list(self.collection.find({'position': {'$exists': False}}).sort('rule_id', 1))
+
+    def ensure_indexes(self):
+        self.collection.create_index('rule_id')
+        self.collection.create_index(RULE_ORDER)
+
+
+class MongoLimiterStore:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def all(self):
+        return list(self.collection.find())
+
+    def insert(self, limiter):
+        self.collection.insert_one(limiter)
+
+    def update(self, limiter_id, fields):
+        self.collection.update_one({'_id': ObjectId(limiter_id)}, {'$set': fields})
+
+    def delete(self, limiter_id):
+        self.collection.delete_one({'_id': ObjectId(limiter_id)})
+
+
+class MongoCounterStore:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def all(self):
+        return list(self.collection.find())
+
+    def add(self, increments):
+        """Add each increment's count to the shared counter of its limiter and value.
+
+        A stored counter whose window started before the increment's
+        window_start is dropped first, so the increment starts a new window
+        at its own timestamp.
+        """
+        if not increments:
+            return
+        self.collection.bulk_write([
+            DeleteMany({'limiter_id': increment['limiter_id'], 'value': increment['value'],
+                        'timestamp': {'$lt': increment['window_start']}})
+            for increment in increments
+        ], ordered=False)
+        self.collection.bulk_write([
+            UpdateOne(
+                {'limiter_id': increment['limiter_id'], 'value': increment['value']},
+                {'$inc': {'count': increment['count']},
+                 '$setOnInsert': {'key': increment['key'], 'timestamp': increment['timestamp']}},
+                upsert=True
+            )
+            for increment in increments
+        ], ordered=False)
+
+    def totals(self, keys):
+        """{(limiter_id, value): counter} for the stored counters of keys."""
+        values = {}
+        for limiter_id, value in keys:
+            values.setdefault(limiter_id, []).append(value)
+        totals = {}
+        for limiter_id, limiter_values in values.items():
+            for counter in self.collection.find({'limiter_id': limiter_id, 'value': {'$in': limiter_values}}):
+                # Servers that counted before counters were shared may have left one each
+                total = totals.get((limiter_id, counter['value']))
+                if total is None or counter['timestamp'] < total['timestamp']:
+                    counter['count'] += total['count'] if total else 0
+                    totals[(limiter_id, counter['value'])] = counter
+                else:
+                    total['count'] += counter['count']
+        return totals
+
+    def delete_expired(self, limiter_id, before):
+        self.collection.delete_many({'limiter_id': limiter_id, 'timestamp': {'$lt': before}})
+
+    def ensure_indexes(self):
+        self.collection.create_index([('limiter_id', 1), ('value', 1)])
+
+
+class MongoRequestStore:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def insert_many(self, documents):
+        """Insert request documents; ones that are already stored are skipped."""
+        self.collection.call('insert_many', _insert_new, documents)
+
+    def find_range(self, start, end, fields=None, raw=False):
+        """Documents with start <= timestamp <= end, newest first.
+
+        With raw=True they are RawBSONDocuments that can be passed on
+        without being decoded.
+        """
+        collection = self.collection.with_options(codec_options=RAW_BSON_OPTIONS) if raw else self.collection
+        projection = {field: 1 for field in fields + ['timestamp']} if fields else None
+        return list(collection.find(
+            {'timestamp': {'$gte': start, '$lte': end}}, projection
+        ).sort('timestamp', -1))
+
+    def count_by(self, field, start, end):
+        counts = {}
+        for row in self.collection.aggregate([
+            {'$match': {'timestamp': {'$gte': start, '$lte': end}}},
+            {'$group': {'_id': f'${field}', 'count': {'$sum': 1}}}
+        ]):
+            counts[str(row['_id'])] = row['count']
+        return counts
+
+    def older_than(self, cutoff, batch_size=1000):
+        """Iterate documents older than cutoff, oldest first."""
+        return self.collection.find({'timestamp': {'$lt': cutoff}}).sort('timestamp', 1).batch_size(batch_size)
+
+    def delete_older_than(self, cutoff):
+        self.collection.delete_many({'timestamp': {'$lt': cutoff}})
+
+    def delete_ids(self, ids, batch_size=1000):
+        for start in range(0, len(ids), batch_size):
+            self.collection.delete_many({'_id': {'$in': ids[start:start + batch_size]}})
+
+    def ensure_indexes(self):
+        # Range queries, the archiver's sorted scan and expiry all go by timestamp
+        self.collection.create_index('timestamp')
+
+
+class MongoStorage:
+    """MongoDB backend; every call goes through a circuit breaker with per-operation deadlines.
+
+    Policy requests and everything else (admin API, background threads) use
+    separate breakers, so neither can open the other's.
+    """
+
+    def __init__(self):
+        self.client = MongoClient(
+            MONGO_URI,
+            connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS
+        )
+        db = self.client[MONGO_DATABASE]
+        self.breaker = CircuitBreaker('mongodb', BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+        self.background_breaker = CircuitBreaker('mongodb-background', BREAKER_FAILURE_THRESHOLD,
+                                                 BREAKER_RESET_TIMEOUT)
+        self.rules = MongoRuleStore(self.guarded(db['rules']))
+        self.rate_limiters = MongoLimiterStore(self.guarded(db['rate_limiters']))
+        self.counters = MongoCounterStore(self.guarded(db['rate_limit_counters']))
+        self.requests = MongoRequestStore(self.guarded(db['requests']))
+
+    def guarded(self, collection):
+        guards = {True: (self.breaker, OPERATION_TIMEOUTS),
+                  False: (self.background_breaker, BACKGROUND_OPERATION_TIMEOUTS)}
+        return GuardedCollection(collection, guards, MONGO_WRITE_TIMEOUT_MS / 1000)
+
+    def status(self):
+        return {**self.breaker.status(), 'background': self.background_breaker.status()}
@@ -0,0 +1,386 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timezone
+
+import bson
+from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+
+from config import SQLITE_BUSY_TIMEOUT_MS, SQLITE_CACHE_KB
+from serialization import RAW_BSON_OPTIONS
+from storage import DeadlineExceeded, StorageError, remaining
+
+# Documents are stored as BSON blobs, exactly like MongoDB keeps them; the
+# columns next to them are only there to be indexed and queried on.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    id TEXT PRIMARY KEY,
+    timestamp REAL NOT NULL,
+    doc BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS requests_timestamp ON requests (timestamp);
+CREATE TABLE IF NOT EXISTS rules (
+    id TEXT PRIMARY KEY,
+    rule_id INTEGER UNIQUE,
+    position REAL,
+    doc BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rules_order ON rules (position, rule_id);
+CREATE TABLE IF NOT EXISTS rate_limiters (
+    id TEXT PRIMARY KEY,
+    doc BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rate_limit_counters (
+    id TEXT PRIMARY KEY,
+    limiter_id TEXT NOT NULL,
+    value TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    count INTEGER NOT NULL,
+    doc BLOB NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS rate_limit_counters_key ON rate_limit_counters (limiter_id, value);
+CREATE INDEX IF NOT EXISTS rate_limit_counters_expiry ON rate_limit_counters (limiter_id, timestamp);
+"""
+
+
+def _seconds(value):
+    # Naive datetimes are UTC, as everywhere else in the datastore
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def _decode(blob):
+    return bson.decode(blob)
+
+
+class SQLiteRuleStore:
+    def __init__(self, db):
+        self.db = db
+
+    def _write(self, connection, rule):
+        connection.execute(
+            'INSERT OR REPLACE INTO rules (id, rule_id, position, doc) VALUES (?, ?, ?, ?)',
+            (str(rule['_id']), rule.get('rule_id'), rule.get('position'), bson.encode(rule))
+        )
+
+    def _one(self, sql, params):
+        rows = self.db.query(sql, params)
+        return _decode(rows[0][0]) if rows else None
+
+    def all(self):
+        return [_decode(doc) for doc, in self.db.query('SELECT doc FROM rules ORDER BY position, rule_id')]
+
+    def get(self, rule_id):
+        return self._one('SELECT doc FROM rules WHERE rule_id = ?', (rule_id,))
+
+    def get_by_id(self, object_id):
+        return self._one('SELECT doc FROM rules WHERE id = ?', (str(ObjectId(object_id)),))
+
+    def next_rule_id(self):
+        highest, = self.db.query('SELECT max(rule_id) FROM rules')[0]
+        return highest + 1 if highest is not None else 1
+
+    def last_position(self):
+        return self.db.query('SELECT max(position) FROM rules')[0][0]
+
+    def neighbour(self, position, rule_id, following):
+        """The closest rule after (or before) position, ignoring rule_id."""
+        if following:
+            sql = 'SELECT doc FROM rules WHERE position > ? AND rule_id != ? ORDER BY position LIMIT 1'
+        else:
+            sql = 'SELECT doc FROM rules WHERE position < ? AND rule_id != ? ORDER BY position DESC LIMIT 1'
+        return self._one(sql, (position, rule_id))
+
+    def insert(self, rule):
+        rule.setdefault('_id', ObjectId())
+        with self.db.transaction() as connection:
+            connection.execute(
+                'INSERT INTO rules (id, rule_id, position, doc) VALUES (?, ?, ?, ?)',
+                (str(rule['_id']), rule.get('rule_id'), rule.get('position'), bson.encode(rule))
+            )
+
+    def update(self, rule_id, fields):
+        with self.db.transaction() as connection:
+            row = connection.execute('SELECT doc FROM rules WHERE rule_id = ?', (rule_id,)).fetchone()
+            if row is None:
+                return None
+            rule = _decode(row[0])
+            rule.update(fields)
+            self._write(connection, rule)
+        return rule
+
+    def delete(self, rule_id):
+        with self.db.transaction() as connection:
+            row = connection.execute('SELECT doc FROM rules WHERE rule_id = ?', (rule_id,)).fetchone()
+            if row is None:
+                return None
+            connection.execute('DELETE FROM rules WHERE rule_id = ?', (rule_id,))
+        return _decode(row[0])
+
+    def bulk_set(self, updates):
+        """Apply [(_id, fields), ...] in one transaction."""
+        with self.db.transaction() as connection:
+            for object_id, fields in updates:
+                row = connection.execute('SELECT doc FROM rules WHERE id = ?', (str(object_id),)).fetchone()
+                if row is not None:
+                    rule = _decode(row[0])
+                    rule.update(fields)
+                    self._write(connection, rule)
+
+    def without_position(self):
+        return [_decode(doc) for doc, in self.db.query('SELECT doc FROM rules WHERE position IS NULL ORDER BY rule_id')]
+
+    def ensure_indexes(self):
+        # Created with the schema
+        pass
+
+
+class SQLiteLimiterStore:
+    def __init__(self, db):
+        self.db = db
+
+    def all(self):
+        return [_decode(doc) for doc, in self.db.query('SELECT doc FROM rate_limiters ORDER BY rowid')]
+
+    def insert(self, limiter):
+        limiter.setdefault('_id', ObjectId())
+        with self.db.transaction() as connection:
+            connection.execute('INSERT INTO rate_limiters (id, doc) VALUES (?, ?)',
+                               (str(limiter['_id']), bson.encode(limiter)))
+
+    def update(self, limiter_id, fields):
+        with self.db.transaction() as connection:
+            row = connection.execute('SELECT doc FROM rate_limiters WHERE id = ?', (limiter_id,)).fetchone()
+            if row is not None:
+                limiter = _decode(row[0])
+                limiter.update(fields)
+                connection.execute('UPDATE rate_limiters SET doc = ? WHERE id = ?', (bson.encode(limiter), limiter_id))
+
+    def delete(self, limiter_id):
+        with self.db.transaction() as connection:
+            connection.execute('DELETE FROM rate_limiters WHERE id = ?', (limiter_id,))
+
+
+class SQLiteCounterStore:
+    def __init__(self, db):
+        self.db = db
+
+    def all(self):
+        counters = []
+        for doc, count in self.db.query('SELECT doc, count FROM rate_limit_counters'):
+            counter = _decode(doc)
+            counter['count'] = count
+            counters.append(counter)
+        return counters
+
+    def add(self, increments):
+        """Add each increment's count to the shared counter of its limiter and value.
+
+        A stored counter whose window started before the increment's
+        window_start is dropped first, so the increment starts a new window
+        at its own timestamp.
+        """
+        if not increments:
+            return
+        with self.db.transaction() as connection:
+            for increment in increments:
+                limiter_id, value = str(increment['limiter_id']), increment['value']
+                connection.execute(
+                    'DELETE FROM rate_limit_counters WHERE limiter_id = ? AND value = ? AND timestamp < ?',
+                    (limiter_id, value, _seconds(increment['window_start']))
+                )
+                counter_id = ObjectId()
+                connection.execute(
+                    'INSERT INTO rate_limit_counters (id, limiter_id, value, timestamp, count, doc) '
+                    'VALUES (?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (limiter_id, value) DO UPDATE SET count = count + excluded.count',
+                    (str(counter_id), limiter_id, value, _seconds(increment['timestamp']), increment['count'],
+                     bson.encode({'_id': counter_id, 'limiter_id': increment['limiter_id'], 'key': increment['key'],
+                                  'value': value, 'timestamp': increment['timestamp']}))
+                )
+
+    def totals(self, keys, batch_size=500):
+        """{(limiter_id, value): counter} for the stored counters of keys."""
+        values = {}
+        for limiter_id, value in keys:
+            values.setdefault(limiter_id, []).append(value)
+        totals = {}
+        for limiter_id, limiter_values in values.items():
+            for start in range(0, len(limiter_values), batch_size):
+                batch = limiter_values[start:start + batch_size]
+                for doc, count in self.db.query(
+                    'SELECT doc, count FROM rate_limit_counters WHERE limiter_id = ? AND value IN (%s)'
+                    % ','.join('?' * len(batch)), [str(limiter_id)] + batch
+                ):
+                    counter = _decode(doc)
+                    counter['count'] = count
+                    totals[(limiter_id, counter['value'])] = counter
+        return totals
+
+    def delete_expired(self, limiter_id, before):
+        with self.db.transaction() as connection:
+            connection.execute('DELETE FROM rate_limit_counters WHERE limiter_id = ? AND timestamp < ?',
+                               (str(limiter_id), _seconds(before)))
+
+    def ensure_indexes(self):
+        # Created with the schema
+        pass
+
+
+class SQLiteRequestStore:
+    def __init__(self, db):
+        self.db = db
+
+    def insert_many(self, documents):
+        """Insert request documents; ones that are already stored are skipped."""
+        rows = []
+        for document in documents:
+            document.setdefault('_id', ObjectId())
+            rows.append((str(document['_id']), _seconds(document['timestamp']), bson.encode(document)))
+        with self.db.transaction() as connection:
+            connection.executemany('INSERT OR IGNORE INTO requests (id, timestamp, doc) VALUES (?, ?, ?)', rows)
+
+    def find_range(self, start, end, fields=None, raw=False):
+        """Documents with start <= timestamp <= end, newest first.
+
+        With raw=True they are RawBSONDocuments that can be passed on
+        without being decoded.
+        """
+        rows = self.db.query(
+            'SELECT doc FROM requests WHERE timestamp BETWEEN ? AND ? ORDER BY timestamp DESC',
+            (_seconds(start), _seconds(end))
+        )
+        if not fields:
+            if raw:
+                return [RawBSONDocument(doc, RAW_BSON_OPTIONS) for doc, in rows]
+            return [_decode(doc) for doc, in rows]
+        documents = []
+        for doc, in rows:
+            document = _decode(doc)
+            projected = {field: document[field] for field in ['_id'] + fields + ['timestamp'] if field in document}
+            documents.append(RawBSONDocument(bson.encode(projected), RAW_BSON_OPTIONS) if raw else projected)
+        return documents
+
+    def count_by(self, field, start, end):
+        counts = {}
+        for doc, in self.db.query('SELECT doc FROM requests WHERE timestamp BETWEEN ? AND ?',
+                                  (_seconds(start), _seconds(end))):
+            value = str(_decode(doc).get(field))
+            counts[value] = counts.get(value, 0) + 1
+        return counts
+
+    def older_than(self, cutoff, batch_size=1000):
+        """Iterate documents older than cutoff, oldest first."""
+        cutoff = _seconds(cutoff)
+        last = (float('-inf'), '')
+        while True:
+            rows = self.db.query(
+                'SELECT timestamp, id, doc FROM requests WHERE timestamp < ? AND (timestamp, id) > (?, ?) '
+                'ORDER BY timestamp, id LIMIT ?',
+                (cutoff, last[0], last[1], batch_size)
+            )
+            for _, _, doc in rows:
+                yield _decode(doc)
+            if len(rows) < batch_size:
+                return
+            last = rows[-1][:2]
+
+    def delete_older_than(self, cutoff):
+        with self.db.transaction() as connection:
+            connection.execute('DELETE FROM requests WHERE timestamp < ?', (_seconds(cutoff),))
+
+    def delete_ids(self, ids):
+        with self.db.transaction() as connection:
+            connection.executemany('DELETE FROM requests WHERE id = ?', [(str(doc_id),) for doc_id in ids])
+
+    def ensure_indexes(self):
+        # Created with the schema
+        pass
+
+
+class SQLiteStorage:
+    """Embedded single-node backend: one WAL-mode SQLite database file.
+
+    WAL lets the dashboard read while the spool replay and the counter writer
+    write, and synchronous=NORMAL only syncs at checkpoints, which is safe
+    against application crashes (the spool still has every request).  Every
+    thread gets its own connection; writes run in short IMMEDIATE
+    transactions so concurrent writers queue on the busy timeout instead of
+    failing half way.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        try:
+            self.connection().executescript(SCHEMA)
+        except sqlite3.Error as e:
+            raise StorageError(str(e)) from e
+        self.rules = SQLiteRuleStore(self)
+        self.rate_limiters = SQLiteLimiterStore(self)
+        self.counters = SQLiteCounterStore(self)
+        self.requests = SQLiteRequestStore(self)
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            connection.execute(f'PRAGMA cache_size = -{SQLITE_CACHE_KB}')
+            connection.execute('PRAGMA temp_store = MEMORY')
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def bounded(self):
+        """The thread's connection, limited to what is left of the enclosing deadline.
+
+        Waiting for the write lock is capped through busy_timeout and a
+        statement that runs past the deadline is interrupted by a progress
+        handler; both are raised as DeadlineExceeded.
+        """
+        connection = self.connection()
+        timeout = remaining()
+        if timeout is None:
+            try:
+                yield connection
+            except sqlite3.Error as e:
+                raise StorageError(str(e)) from e
+            return
+        expires = time.monotonic() + timeout
+        connection.execute(f'PRAGMA busy_timeout = {min(SQLITE_BUSY_TIMEOUT_MS, int(timeout * 1000))}')
+        connection.set_progress_handler(lambda: time.monotonic() > expires, 1000)
+        try:
+            yield connection
+        except sqlite3.Error as e:
+            if time.monotonic() > expires:
+                raise DeadlineExceeded(str(e)) from e
+            raise StorageError(str(e)) from e
+        finally:
+            connection.set_progress_handler(None, 0)
+            connection.execute(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}')
+
+    def query(self, sql, params=()):
+        with self.bounded() as connection:
+            return connection.execute(sql, params).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        with self.bounded() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                # An interrupted statement may already have rolled back
+                if connection.in_transaction:
+                    connection.set_progress_handler(None, 0)
+                    connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    def status(self):
+        return {'name': 'sqlite', 'path': self.path}
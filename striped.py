@@ -0,0 +1,171 @@
+import itertools
+import threading
+import time
+from collections import deque
+
+from bson import ObjectId
+
+_next_stripe = itertools.count()
+_thread_stripe = threading.local()
+
+
+def thread_stripe(stripes):
+    """Stripe of the calling thread; threads are spread round-robin."""
+    index = getattr(_thread_stripe, 'index', None)
+    if index is None:
+        index = _thread_stripe.index = next(_next_stripe)
+    return index % stripes
+
+
+class StripedCounters:
+    """Fixed-window exact counters spread over independently locked stripes.
+
+    A key always maps to the same stripe, so the check-and-increment for one
+    key is atomic while requests for other keys proceed under other locks.
+    Keys are strings, whose hash is computed once and cached, so picking the
+    stripe and finding the counter cost a single hash computation.
+    Changed counters are remembered per stripe until drain() hands them to
+    the writer that persists them.  Each counter's `synced` is the part of
+    its count that is already in the shared total.  With max_keys set, a
+    stripe never holds more than its share of max_keys counters.
+    """
+
+    def __init__(self, stripes=16, max_keys=None):
+        self.stripes = [({}, {}, threading.Lock()) for _ in range(stripes)]
+        self.stripe_keys = max(1, max_keys // stripes) if max_keys else None
+
+    def _stripe(self, key):
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def increment(self, key, limit, window_start, fields, now, weight=1, estimate=None):
+        """Add weight to key's window unless that would take it over limit.
+
+        A counter older than window_start is replaced by a new one carrying
+        `fields`.  A key promoted from a sketch passes the sketch's estimate
+        (which includes this hit) so its new counter starts from what was
+        already seen.  Rejected hits are not counted.  Returns (allowed, counter),
+        or (None, None) if a new key does not fit into its stripe.
+        """
+        counters, dirty, lock = self._stripe(key)
+        with lock:
+            counter = counters.get(key)
+            if counter is None and self.stripe_keys is not None and len(counters) >= self.stripe_keys:
+                self._discard_expired(counters, dirty, window_start)
+                if len(counters) >= self.stripe_keys:
+                    return None, None
+            if counter is None or counter['timestamp'] < window_start:
+                count = 0 if estimate is None else min(max(estimate - weight, 0), limit)
+                counter = counters[key] = dict(fields, _id=ObjectId(), count=count, synced=0, timestamp=now)
+                dirty[key] = counter
+            if counter['count'] + weight > limit:
+                return False, counter
+            counter['count'] += weight
+            dirty[key] = counter
+            return True, counter
+
+    @staticmethod
+    def _discard_expired(counters, dirty, window_start):
+        for key in [key for key, counter in counters.items() if counter['timestamp'] < window_start]:
+            del counters[key]
+            dirty.pop(key, None)
+
+    def load_many(self, loaded):
+        """Add stored counters, keyed by their 'value'; the newest window per key wins.
+
+        Loaded counts count as synced.  Returns the counters held for the
+        loaded keys afterwards.
+        """
+        by_stripe = [[] for _ in self.stripes]
+        for counter in loaded:
+            by_stripe[hash(counter['value']) % len(self.stripes)].append(counter)
+        held = {}
+        for (counters, _, lock), stripe_loaded in zip(self.stripes, by_stripe):
+            with lock:
+                for counter in stripe_loaded:
+                    current = counters.get(counter['value'])
+                    if current is None and self.stripe_keys is not None and len(counters) >= self.stripe_keys:
+                        continue
+                    if current is None or current['timestamp'] < counter['timestamp']:
+                        current = counters[counter['value']] = dict(counter, synced=counter['count'])
+                    elif current['_id'] == counter['_id']:
+                        # Loaded from two places (warm snapshot and datastore); keep the higher count
+                        current['count'] = max(current['count'], counter['count'])
+                        current['synced'] = max(current['synced'], counter['count'])
+                    held[counter['value']] = current
+        return list(held.values())
+
+    def acknowledge(self, sent):
+        """Count the counter that `sent` was drained from as synced up to sent's count."""
+        counters, _, lock = self._stripe(sent['value'])
+        with lock:
+            counter = counters.get(sent['value'])
+            if counter is not None and counter['_id'] == sent['_id']:
+                counter['synced'] = sent['count']
+
+    def sync(self, sent, stored):
+        """Adopt the shared total `stored` for the counter that `sent` was drained from.
+
+        Hits counted since the drain stay on top of the total.  Returns a
+        copy of the updated counter, or None if the key has moved on to a
+        new window meanwhile.
+        """
+        counters, _, lock = self._stripe(sent['value'])
+        with lock:
+            counter = counters.get(sent['value'])
+            if counter is None or counter['_id'] != sent['_id']:
+                return None
+            since = counter['count'] - sent['count']
+            counter.update(_id=stored['_id'], timestamp=stored['timestamp'], synced=stored['count'],
+                           count=stored['count'] + since)
+            return dict(counter)
+
+    def drain(self):
+        """Copies of every counter changed since the last drain."""
+        changed = []
+        for _, dirty, lock in self.stripes:
+            with lock:
+                changed.extend(dict(counter) for counter in dirty.values())
+                dirty.clear()
+        return changed
+
+    def values(self):
+        """Copies of every counter."""
+        copies = []
+        for counters, _, lock in self.stripes:
+            with lock:
+                copies.extend(dict(counter) for counter in counters.values())
+        return copies
+
+    def discard_where(self, predicate):
+        for counters, dirty, lock in self.stripes:
+            with lock:
+                for key in [key for key, counter in counters.items() if predicate(key, counter)]:
+                    del counters[key]
+                    dirty.pop(key, None)
+
+    def __len__(self):
+        return sum(len(counters) for counters, _, _ in self.stripes)
+
+
+class StripedRecentBuffer:
+    """The most recent items, appended to per-thread ring buffers.
+
+    Appends never contend with each other; readers merge the stripes and
+    sort by time.  Each stripe holds capacity / stripes items, so a thread
+    handling a burst can push out its own older items a little earlier.
+    """
+
+    def __init__(self, max_age_seconds, capacity=10000, stripes=16):
+        self.max_age_seconds = max_age_seconds
+        self.stripes = [deque(maxlen=max(1, capacity // stripes)) for _ in range(stripes)]
+
+    def append(self, key, value, now):
+        self.stripes[thread_stripe(len(self.stripes))].append((now, key, value))
+
+    def items(self, start, end):
+        """(key, value, timestamp) newest first for items between start and end."""
+        oldest = max(start, time.time() - self.max_age_seconds)
+        # list() copies a deque without releasing the GIL
+        entries = [entry for stripe in self.stripes for entry in list(stripe) if oldest <= entry[0] <= end]
+        entries.sort(key=lambda entry: entry[0], reverse=True)
+        return [(key, value, timestamp) for timestamp, key, value in entries]